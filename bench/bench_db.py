@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Benchmarks of core.db.mysql and core.db.orm against a local database.
+
+    python bench/bench_db.py [--load] [--users 1000 --blogs 10 --comments 10] [-n number] [-o result.json] [-c baseline.json]
+
+SQLite is used by default so the numbers are reproducible anywhere; pass
+--engine mysql and credentials to run against a throwaway MySQL database.
+--load (re)generates the data with bench/datagen.py first.
+'''
+import os
+import sys
+import random
+import optparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from core.db import mysql
+from web.models import User, Blog, Comment
+import datagen
+import harness
+
+_FIND_SIZES = (1, 10, 100, 1000)
+
+_RECENT_BLOGS = 'order by `created_at` desc limit ?'
+
+
+def benchmarks(users, rng):
+    '''
+    Return [(name, fn, number_scale)] in the order they must run: inserts
+    come last so they do not change what the reads see.
+    '''
+    def get_user():
+        return User.get(datagen.row_id(datagen.USER, rng.randrange(users)))
+
+    def find_by(n):
+        return lambda: Blog.find_by(_RECENT_BLOGS, n)
+
+    def rows_tuple():
+        cursor = mysql._db_ctx.connection.cursor()
+        sql = 'select * from `blogs` %s' % _RECENT_BLOGS
+        cursor.execute(sql if mysql.engine.paramstyle == 'qmark' else sql.replace('?', '%s'), (1000, ))
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
+
+    def rows_dict():
+        return mysql.select('select * from `blogs` %s' % _RECENT_BLOGS, 1000)
+
+    def insert_comment():
+        return Comment(blog_id=datagen.row_id(datagen.BLOG, 0), user_id=datagen.row_id(datagen.USER, 0), user_name='User 0',
+                user_image='', content='benchmark comment').insert()
+
+    def insert_100_in_transaction():
+        with mysql.transaction():
+            for i in xrange(100):
+                insert_comment()
+
+    L = [('db_get', get_user, 1)]
+    for n in _FIND_SIZES:
+        L.append(('db_find_by_%d' % n, find_by(n), 1.0 / max(1, n // 10)))
+    L.extend([
+        ('db_rows_tuple_1000', rows_tuple, 0.01),
+        ('db_rows_dict_1000', rows_dict, 0.01),
+        ('db_rows_model_1000', find_by(1000), 0.01),
+        ('db_count_all_users', User.count_all, 0.1),
+        ('db_count_all_comments', Comment.count_all, 0.01),
+        ('db_insert', insert_comment, 1),
+        ('db_insert_100_in_transaction', insert_100_in_transaction, 0.01),
+    ])
+    return L
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [name ...]')
+    datagen.add_engine_options(parser)
+    parser.add_option('--load', action='store_true', help='generate the data first')
+    parser.add_option('--users', type='int', default=1000)
+    parser.add_option('--blogs', type='int', default=10, help='blogs per user')
+    parser.add_option('--comments', type='int', default=10, help='comments per blog')
+    parser.add_option('-n', '--number', type='int', default=2000, help='calls of the cheapest benchmarks')
+    parser.add_option('-o', '--output', help='write results as JSON')
+    parser.add_option('-c', '--compare', help='JSON of an earlier run to compare with')
+    options, names = parser.parse_args()
+    datagen.create_engine(options)
+    if options.load or (options.engine == 'sqlite' and not os.path.exists(options.database)):
+        datagen.generate(options.users, options.blogs, options.comments)
+    rng = random.Random(1)
+    users = User.count_all()
+    results = {}
+    # the connection for a single statement is measured on its own:
+    results['db_get_new_connection'] = harness.measure(lambda: User.get(datagen.row_id(datagen.USER, rng.randrange(users))), max(10, options.number // 10), 10)
+    with mysql.connection():
+        for name, fn, scale in benchmarks(users, rng):
+            if names and not any(n in name for n in names):
+                continue
+            number = max(10, int(options.number * scale))
+            results[name] = harness.measure(fn, number, min(number // 10, 100))
+    for name in ('db_find_by_%d' % n for n in _FIND_SIZES):
+        if name in results:
+            results[name]['rows_per_sec'] = round(results[name]['requests_per_sec'] * int(name.rsplit('_', 1)[1]), 1)
+    baseline = harness.load(options.compare) if options.compare else None
+    harness.print_results(results, baseline)
+    if options.output:
+        data = harness.report(results)
+        data['dataset'] = dict(engine=options.engine, users=users, blogs=Blog.count_all(), comments=Comment.count_all())
+        harness.save(data, options.output)
+        print 'saved to %s' % options.output
+
+
+if __name__ == '__main__':
+    main()
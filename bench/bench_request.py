@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Per-request cost of Request/Response before and after the __slots__ rewrite.
+
+The legacy classes below are trimmed copies of the previous implementation.
+Every value returned to the simulated handler is kept alive, so
+harness.count_allocations gives the containers a request allocates.
+
+    python bench/bench_request.py [number]
+'''
+import os
+import sys
+import timeit
+import urllib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from core.utils import Dict
+from core.application import Request, Response, _RESPONSE_HEADER_DICT, _HEADER_X_POWERED_BY, _unquote
+import harness
+
+
+class LegacyRequest(object):
+    def __init__(self, environ):
+        self._environ = environ
+
+    @property
+    def path_info(self):
+        return urllib.unquote(self._environ.get('PATH_INFO', ''))
+
+    def _get_headers(self):
+        if not hasattr(self, '_headers'):
+            hdrs = {}
+            for k, v in self._environ.iteritems():
+                if k.startswith('HTTP_'):
+                    hdrs[k[5:].replace('_', '-').upper()] = v.decode('utf-8')
+            self._headers = hdrs
+        return self._headers
+
+    @property
+    def headers(self):
+        return dict(**self._get_headers())
+
+    def header(self, header, default=None):
+        return self._get_headers().get(header.upper(), default)
+
+    def _get_cookies(self):
+        if not hasattr(self, '_cookies'):
+            cookies = {}
+            cookie_str = self._environ.get('HTTP_COOKIE')
+            if cookie_str:
+                for c in cookie_str.split(';'):
+                    pos = c.find('=')
+                    if pos > 0:
+                        cookies[c[:pos].strip()] = _unquote(c[pos + 1:])
+            self._cookies = cookies
+        return self._cookies
+
+    @property
+    def cookies(self):
+        return Dict(**self._get_cookies())
+
+
+class LegacyResponse(object):
+    def __init__(self):
+        self.status = '200 OK'
+        self._headers = {'CONTENT-TYPE': 'text/html; charset=utf-8'}
+
+    @property
+    def headers(self):
+        L = [(_RESPONSE_HEADER_DICT.get(k, k), v) for k, v in self._headers.iteritems()]
+        if hasattr(self, '_cookies'):
+            for v in self._cookies.itervalues():
+                L.append(('Set-Cookie', v))
+        L.append(_HEADER_X_POWERED_BY)
+        return L
+
+
+ENVIRON = {
+    'REQUEST_METHOD': 'GET',
+    'PATH_INFO': '/api/blogs/001',
+    'QUERY_STRING': 'page=2',
+    'HTTP_HOST': 'localhost',
+    'HTTP_USER_AGENT': 'Mozilla/5.0',
+    'HTTP_ACCEPT': 'text/html',
+    'HTTP_ACCEPT_ENCODING': 'gzip',
+    'HTTP_COOKIE': 'session=abc-123-def; theme=dark',
+}
+
+
+def one_request(request_class, response_class):
+    keep = []
+    request = request_class(ENVIRON)
+    response = response_class()
+    # routing, an interceptor and the handler each look at the path, headers and cookies:
+    for i in xrange(3):
+        keep.append(request.path_info)
+        keep.append(request.headers)
+        keep.append(request.cookies)
+    keep.append(response.headers)
+    keep.append(request)
+    keep.append(response)
+    return keep
+
+
+def instance_size(obj):
+    size = sys.getsizeof(obj)
+    if not hasattr(type(obj), '__slots__'):
+        size = size + sys.getsizeof(obj.__dict__)
+    return size
+
+
+def bench(name, request_class, response_class, number):
+    fn = lambda: one_request(request_class, response_class)
+    t = timeit.timeit(fn, number=number)
+    # the list one_request() returns is one of the containers:
+    allocs = harness.count_allocations(fn, overhead=1)
+    size = instance_size(request_class(ENVIRON)) + instance_size(response_class())
+    print '%-7s %6.2f us/request, ~%5.1f containers/request, %4d bytes of instances' % (name, t * 1e6 / number, allocs, size)
+
+
+if __name__ == '__main__':
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    bench('before', LegacyRequest, LegacyResponse, number)
+    bench('after', Request, Response, number)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Compare the linear scan over dynamic routes with the trie dispatcher.
+
+    python bench/bench_routing.py [number]
+'''
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from core.application import Route, _Dispatcher, get
+import harness
+
+
+def _make_routes(n):
+    routes = []
+    for i in range(n):
+        if i % 2:
+            path = '/r%d/:id/items/:item' % i
+        else:
+            path = '/r%d/:name-:page' % i
+        routes.append(Route(get(path)(lambda *args: args)))
+    return routes
+
+
+def _linear(routes, url):
+    for fn in routes:
+        args = fn.match(url)
+        if args:
+            return fn, args
+    return None, None
+
+
+def bench(n, number):
+    routes = _make_routes(n)
+    dispatcher = _Dispatcher(routes)
+    urls = ['/r0/blog-1', '/r%d/42/items/7' % (n // 2 + 1), '/r%d/42/items/7' % (n - 1), '/missing/42']
+    for url in urls:
+        assert _linear(routes, url) == dispatcher.match(url), url
+    linear = lambda: [_linear(routes, url) for url in urls]
+    trie = lambda: [dispatcher.match(url) for url in urls]
+    t_linear = timeit.timeit(linear, number=number)
+    t_trie = timeit.timeit(trie, number=number)
+    lookups = number * len(urls)
+    # minus the list holding the results of the lookups:
+    a_linear = harness.count_allocations(linear, overhead=1) / len(urls)
+    a_trie = harness.count_allocations(trie, overhead=1) / len(urls)
+    print '%5d routes: linear %8.2f us/lookup, trie %6.2f us/lookup, speedup x%.1f, allocs/lookup linear ~%.1f trie ~%.1f' % (
+        n, t_linear * 1e6 / lookups, t_trie * 1e6 / lookups, t_linear / t_trie, a_linear, a_trie)
+
+
+if __name__ == '__main__':
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for n in (10, 100, 1000):
+        bench(n, number)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Time and memory of materializing query results as Dict, mysql.Row and Model.
+
+    python bench/bench_rows.py [--rows 1000000] [--db [--engine sqlite --database /tmp/awesome-bench.db]] [-o result.json]
+
+By default the rows are synthetic tuples shaped like the comments table, as
+cursor.fetchall() returns them, so only the row construction is measured.
+Every variant runs in a forked child; memory is the RSS growth of holding
+all rows (the column values are shared and not counted), the size of one
+row as reported by sys.getsizeof and the gc-tracked allocations per row
+(harness.count_allocations of a second build). --db instead selects the comments
+table with select() and select_rows() (load it with bench/datagen.py).
+'''
+import os
+import sys
+import gc
+import json
+import time
+import optparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from core.utils import Dict
+from core.db import mysql
+from web.models import Comment
+import datagen
+import harness
+
+_NAMES = ('id', 'blog_id', 'user_id', 'user_name', 'user_image', 'content', 'created_at')
+
+
+def _rss_kb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def _values(n):
+    blog, user = datagen.row_id(datagen.BLOG, 0), datagen.row_id(datagen.USER, 0)
+    image, content = 'http://www.gravatar.com/avatar/0', 'benchmark comment'
+    return [(datagen.row_id(datagen.COMMENT, i), blog, user, u'User 0', image, content, i / 1000.0) for i in xrange(n)]
+
+
+def _model(names, rows):
+    return [Comment(**Dict(names, values)) for values in rows]
+
+
+def _model_from_rows(names, rows):
+    return [Comment.from_row(r) for r in map(mysql.row_type(names), rows)]
+
+
+_SYNTHETIC = (
+    ('tuple', lambda names, rows: list(rows)),
+    ('dict', lambda names, rows: [Dict(names, values) for values in rows]),
+    ('row', lambda names, rows: map(mysql.row_type(names), rows)),
+    ('dict_to_model', _model),
+    ('row_to_model', _model_from_rows),
+)
+
+
+def _in_child(fn):
+    '''
+    Run fn() -> dict in a forked process and return its result.
+    '''
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            os.write(w, json.dumps(fn()))
+        finally:
+            os._exit(0)
+    os.close(w)
+    data = []
+    while True:
+        chunk = os.read(r, 65536)
+        if not chunk:
+            break
+        data.append(chunk)
+    os.close(r)
+    os.waitpid(pid, 0)
+    return json.loads(''.join(data))
+
+
+def _materialize(build, prepare):
+    def run():
+        args = prepare()
+        gc.collect()
+        gc.disable()
+        before = _rss_kb()
+        start = time.time()
+        result = build(*args)
+        elapsed = time.time() - start
+        rss = _rss_kb() - before
+        gc.enable()
+        rows, size = len(result), sys.getsizeof(result[0])
+        del result
+        # minus the list holding the rows:
+        allocs = harness.count_allocations(lambda: build(*args), 1, overhead=1) / rows
+        return dict(rows=rows, seconds=round(elapsed, 3), rows_per_sec=round(rows / elapsed, 1),
+                    rss_mb=round(rss / 1024.0, 1), bytes_per_row=round(rss * 1024.0 / rows, 1),
+                    getsizeof_row=size, allocations_per_row=round(allocs, 2))
+    return run
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    datagen.add_engine_options(parser)
+    parser.add_option('--rows', type='int', default=1000000, help='synthetic rows')
+    parser.add_option('--db', action='store_true', help='select the comments table instead')
+    parser.add_option('-o', '--output', help='write results as JSON')
+    options, args = parser.parse_args()
+    results = {}
+    if options.db:
+        datagen.create_engine(options)
+        sql = 'select * from `comments`'
+        for name, fn in (('db_select_dict', lambda: mysql.select(sql)), ('db_select_rows', lambda: mysql.select_rows(sql))):
+            results[name] = _in_child(_materialize(fn, lambda: ()))
+    else:
+        prepare = lambda: (_NAMES, _values(options.rows))
+        for name, fn in _SYNTHETIC:
+            results[name] = _in_child(_materialize(fn, prepare))
+    print '%-16s %10s %12s %10s %12s %10s %10s' % ('variant', 'rows', 'rows/s', 'rss MB', 'bytes/row', 'getsizeof', 'allocs~')
+    for name in sorted(results, key=lambda n: results[n]['bytes_per_row']):
+        r = results[name]
+        print '%-16s %10d %12.1f %10.1f %12.1f %10d %10.2f' % (name, r['rows'], r['rows_per_sec'], r['rss_mb'], r['bytes_per_row'],
+                                                              r['getsizeof_row'], r['allocations_per_row'])
+    if options.output:
+        harness.save(harness.report(results), options.output)
+        print 'saved to %s' % options.output
+
+
+if __name__ == '__main__':
+    main()
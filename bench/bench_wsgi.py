@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+In-process benchmarks of the WSGI callable: synthetic environ dicts are
+passed straight to get_wsgi_application(), no socket is involved.
+
+    python bench/bench_wsgi.py [-n number] [-o result.json] [-c baseline.json] [name ...]
+
+Results are printed and, with -o, written as JSON so that runs of two
+commits can be compared with -c.
+'''
+import os
+import sys
+import optparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from core.application import WSGIApplication, get, post, ctx, interceptor
+from core.apis import api
+import harness
+
+_ENVIRON = {
+    'REQUEST_METHOD': 'GET',
+    'SCRIPT_NAME': '',
+    'PATH_INFO': '/',
+    'QUERY_STRING': '',
+    'SERVER_NAME': 'localhost',
+    'SERVER_PORT': '8080',
+    'SERVER_PROTOCOL': 'HTTP/1.1',
+    'HTTP_HOST': 'localhost:8080',
+    'HTTP_USER_AGENT': 'Mozilla/5.0 (X11; Linux x86_64) bench',
+    'HTTP_ACCEPT': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'HTTP_ACCEPT_LANGUAGE': 'en-US,en;q=0.5',
+    'wsgi.url_scheme': 'http',
+    'wsgi.errors': sys.stderr,
+    'wsgi.multithread': False,
+    'wsgi.multiprocess': False,
+    'wsgi.run_once': False,
+    'wsgi.version': (1, 0),
+}
+
+
+_current = [None, None]
+
+
+def _start_response(status, headers, exc_info=None):
+    # the request is still running: keep its objects for count_allocations
+    _current[0] = ctx.request
+    _current[1] = ctx.response
+
+
+def _caller(wsgi, path='/', method='GET', body='', **environ):
+    '''
+    Return a function doing one request and consuming the response body,
+    it returns what the request built for harness.count_allocations.
+    '''
+    base = dict(_ENVIRON, PATH_INFO=path, REQUEST_METHOD=method, **environ)
+    if body:
+        base['CONTENT_LENGTH'] = str(len(body))
+
+    def call():
+        env = dict(base)
+        env['wsgi.input'] = StringIO(body)
+        r = wsgi(env, _start_response)
+        data = ''.join(r)
+        if hasattr(r, 'close'):
+            r.close()
+        return env, data, _current[0], _current[1]
+    return call
+
+
+def _app(*handlers):
+    app = WSGIApplication(os.path.dirname(os.path.realpath(__file__)))
+    for fn in handlers:
+        if hasattr(fn, '__interceptor__'):
+            app.add_interceptor(fn)
+        else:
+            app.add_url(fn)
+    return app.get_wsgi_application()
+
+
+def bench_routing():
+    handlers = []
+    for i in range(200):
+        handlers.append(get('/pages/page%d' % i)(lambda: 'ok'))
+        handlers.append(get('/blog%d/:id/comments/:cid' % i)(lambda id, cid: 'ok'))
+    wsgi = _app(*handlers)
+    return {
+        'routing_static': _caller(wsgi, '/pages/page150'),
+        'routing_dynamic': _caller(wsgi, '/blog150/42/comments/7'),
+        'routing_notfound': _caller(wsgi, '/nothing/here'),
+    }
+
+
+def bench_request_parsing():
+    @get('/')
+    def index():
+        request = ctx.request
+        request.cookie('session')
+        request.cookie('theme')
+        request.header('User-Agent')
+        request.header('Accept-Language')
+        return request.get('page', '1')
+
+    wsgi = _app(index)
+    cookies = '; '.join('c%d=value%d' % (i, i) for i in range(20)) + '; session=0123456789abcdef-1400000000-0123456789abcdef0123456789abcdef; theme=dark'
+    extra = dict(('HTTP_X_HEADER_%d' % i, 'value %d' % i) for i in range(20))
+    return {
+        'request_cookies_headers': _caller(wsgi, '/', QUERY_STRING='page=3&sort=desc', HTTP_COOKIE=cookies, **extra),
+    }
+
+
+def bench_forms():
+    @post('/form')
+    def form():
+        i = ctx.request.input()
+        return str(len(i))
+
+    wsgi = _app(form)
+    urlencoded = '&'.join('field%d=some+value+%d%%21' % (i, i) for i in range(20))
+    boundary = '----bench0123456789'
+    parts = []
+    for i in range(10):
+        parts.append('--%s\r\nContent-Disposition: form-data; name="field%d"\r\n\r\nvalue %d\r\n' % (boundary, i, i))
+    parts.append('--%s\r\nContent-Disposition: form-data; name="file"; filename="a.txt"\r\nContent-Type: text/plain\r\n\r\n%s\r\n' % (boundary, 'x' * 4096))
+    parts.append('--%s--\r\n' % boundary)
+    multipart = ''.join(parts)
+    return {
+        'form_urlencoded': _caller(wsgi, '/form', 'POST', urlencoded, CONTENT_TYPE='application/x-www-form-urlencoded'),
+        'form_multipart': _caller(wsgi, '/form', 'POST', multipart, CONTENT_TYPE='multipart/form-data; boundary=%s' % boundary),
+    }
+
+
+def bench_interceptors():
+    chain = []
+    for i in range(5):
+        @interceptor('/api/')
+        def _pass(next):
+            return next()
+        chain.append(_pass)
+
+    @interceptor('/manage/')
+    def _other(next):
+        return next()
+
+    @get('/api/items/:id')
+    def item(id):
+        return id
+
+    wsgi = _app(*(chain + [_other, item]))
+    return {
+        'interceptor_chain_5': _caller(wsgi, '/api/items/42'),
+    }
+
+
+def bench_response_headers():
+    @get('/headers')
+    def headers():
+        response = ctx.response
+        for i in range(10):
+            response.set_header('X-Bench-%d' % i, 'value %d' % i)
+        response.set_cookie('session', 'abc', max_age=3600)
+        response.set_cookie('theme', 'dark')
+        response.content_type = 'text/plain'
+        return 'ok'
+
+    wsgi = _app(headers)
+    return {
+        'response_headers': _caller(wsgi, '/headers'),
+    }
+
+
+def bench_json():
+    blogs = [dict(id='%050d' % i, name=u'Blog %d' % i, summary=u'Summary of blog %d ' % i * 4, created_at=1400000000.0 + i) for i in range(20)]
+
+    @api
+    @get('/api/blogs')
+    def api_blogs():
+        return dict(blogs=blogs)
+
+    wsgi = _app(api_blogs)
+    return {
+        'api_json_20_items': _caller(wsgi, '/api/blogs'),
+    }
+
+
+BENCHMARKS = (bench_routing, bench_request_parsing, bench_forms, bench_interceptors, bench_response_headers, bench_json)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [-n number] [-o result.json] [-c baseline.json] [name ...]')
+    parser.add_option('-n', '--number', type='int', default=10000, help='requests per benchmark')
+    parser.add_option('-o', '--output', help='write results as JSON')
+    parser.add_option('-c', '--compare', help='JSON of an earlier run to compare with')
+    options, names = parser.parse_args()
+    results = {}
+    for factory in BENCHMARKS:
+        for name, fn in sorted(factory().iteritems()):
+            if names and not any(n in name for n in names):
+                continue
+            results[name] = harness.measure(fn, options.number)
+    baseline = harness.load(options.compare) if options.compare else None
+    harness.print_results(results, baseline)
+    if options.output:
+        harness.save(harness.report(results), options.output)
+        print 'saved to %s' % options.output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Generate users, blogs and comments matching web/models.py.
+
+Rows are reproducible: ids are derived from the row number and texts from
+a seeded random generator, so two loads with the same sizes are identical.
+Rows are streamed to the database with executemany in batches, so millions
+of comments do not have to fit in memory.
+
+    python bench/datagen.py [--users 1000] [--blogs 10] [--comments 10] [--engine sqlite --database /tmp/awesome-bench.db]
+'''
+import os
+import sys
+import time
+import random
+import hashlib
+import logging
+import optparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from core.db import mysql
+from web.models import User, Blog, Comment
+
+T0 = 1400000000000
+
+USER, BLOG, COMMENT = 1, 2, 3
+
+_WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore '
+          'et dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip').split()
+
+INDEXES = (
+    'create index `idx_blogs_created_at` on `blogs` (`created_at`)',
+    'create index `idx_blogs_user_id` on `blogs` (`user_id`)',
+    'create index `idx_comments_blog_id` on `comments` (`blog_id`)',
+)
+
+
+def row_id(kind, n):
+    '''
+    The 50 chars id of row n, sorted by creation like next_id().
+    >>> len(row_id(USER, 7))
+    50
+    >>> row_id(BLOG, 1) < row_id(BLOG, 2)
+    True
+    '''
+    return '%015d%032x000' % (T0 + n, (kind << 120) | n)
+
+
+def _text(rng, size):
+    L = []
+    n = 0
+    while n < size:
+        w = rng.choice(_WORDS)
+        L.append(w)
+        n = n + len(w) + 1
+    return ' '.join(L)[:size]
+
+
+def _users(rng, users):
+    for i in xrange(users):
+        yield (row_id(USER, i), 'user%d@example.com' % i, hashlib.md5('password%d' % i).hexdigest(), i == 0,
+               'User %d' % i, 'http://www.gravatar.com/avatar/%032x' % i, (T0 + i) / 1000.0)
+
+
+def _blogs(rng, users, blogs, content_size):
+    n = 0
+    for u in xrange(users):
+        for b in xrange(blogs):
+            yield (row_id(BLOG, n), row_id(USER, u), 'User %d' % u, 'http://www.gravatar.com/avatar/%032x' % u,
+                   _text(rng, 40), _text(rng, 180), _text(rng, content_size), (T0 + n) / 1000.0)
+            n = n + 1
+
+
+def _comments(rng, total_blogs, comments, content_size, users):
+    n = 0
+    for b in xrange(total_blogs):
+        for c in xrange(comments):
+            u = rng.randrange(users)
+            yield (row_id(COMMENT, n), row_id(BLOG, b), row_id(USER, u), 'User %d' % u,
+                   'http://www.gravatar.com/avatar/%032x' % u, _text(rng, content_size), (T0 + n) / 1000.0)
+            n = n + 1
+
+
+def _columns(model):
+    return [f.name for f in sorted(model.__mapping__.values(), key=lambda f: f.order)]
+
+
+def _load(connection, model, rows, batch):
+    cols = _columns(model)
+    mark = '?' if mysql.engine.paramstyle == 'qmark' else '%s'
+    sql = 'insert into `%s` (%s) values (%s)' % (model.__table__, ','.join('`%s`' % c for c in cols), ','.join([mark] * len(cols)))
+    cursor = connection.cursor()
+    count = 0
+    buf = []
+    for row in rows:
+        buf.append(row)
+        if len(buf) == batch:
+            cursor.executemany(sql, buf)
+            connection.commit()
+            count = count + len(buf)
+            buf = []
+    if buf:
+        cursor.executemany(sql, buf)
+        connection.commit()
+        count = count + len(buf)
+    cursor.close()
+    return count
+
+
+def generate(users=1000, blogs=10, comments=10, blog_size=1000, comment_size=200, batch=5000, seed=0):
+    '''
+    (Re)create the tables of User, Blog and Comment with users rows, blogs
+    per user and comments per blog. Return {table: rows}.
+    '''
+    rng = random.Random(seed)
+    connection = mysql.engine.connect()
+    try:
+        cursor = connection.cursor()
+        for model in (User, Blog, Comment):
+            cursor.execute('drop table if exists `%s`' % model.__table__)
+            cursor.execute(model().__sql__())
+        for sql in INDEXES:
+            cursor.execute(sql)
+        connection.commit()
+        cursor.close()
+        counts = {}
+        for model, rows in ((User, _users(rng, users)),
+                            (Blog, _blogs(rng, users, blogs, blog_size)),
+                            (Comment, _comments(rng, users * blogs, comments, comment_size, users))):
+            start = time.time()
+            counts[model.__table__] = n = _load(connection, model, rows, batch)
+            logging.info('loaded %d %s in %.1fs' % (n, model.__table__, time.time() - start))
+        return counts
+    finally:
+        mysql.engine.release(connection)
+
+
+def add_engine_options(parser):
+    parser.add_option('--engine', default='sqlite', help='sqlite or mysql')
+    parser.add_option('--database', default='/tmp/awesome-bench.db', help='file for sqlite, database name for mysql')
+    parser.add_option('--user', default='www-data')
+    parser.add_option('--password', default='www-data')
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=3306)
+
+
+def create_engine(options):
+    mysql.create_engine(options.engine, options.user, options.password, options.database, options.host, options.port)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    add_engine_options(parser)
+    parser.add_option('--users', type='int', default=1000)
+    parser.add_option('--blogs', type='int', default=10, help='blogs per user')
+    parser.add_option('--comments', type='int', default=10, help='comments per blog')
+    parser.add_option('--seed', type='int', default=0)
+    options, args = parser.parse_args()
+    # importing the models may already have configured the root logger:
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.INFO)
+    create_engine(options)
+    print generate(options.users, options.blogs, options.comments, seed=options.seed)
+
+
+if __name__ == '__main__':
+    main()
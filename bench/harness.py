@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+'''
+Timing, percentiles and JSON reports shared by the bench scripts.
+
+Each call is timed on its own so p50/p99 are per request. Python 2 has no
+allocation tracer, so allocations are approximated by the new gc-tracked
+containers with the collector disabled and every return value kept alive
+(see count_allocations, the allocs~ column), and memory as the peak RSS.
+'''
+import gc
+import os
+import sys
+import json
+import math
+import time
+import platform
+import resource
+import subprocess
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def percentile(sorted_samples, p):
+    '''
+    >>> percentile([1, 2, 3, 4], 50)
+    2
+    >>> percentile([1, 2, 3, 4], 99)
+    4
+    '''
+    if not sorted_samples:
+        return 0
+    k = int(math.ceil(p / 100.0 * len(sorted_samples))) - 1
+    return sorted_samples[max(0, min(k, len(sorted_samples) - 1))]
+
+
+def count_allocations(fn, number=1000, overhead=0):
+    '''
+    Return the gc-tracked containers allocated per call of fn(), less
+    overhead (such as the list holding what a call returns), never below 0.
+    The collector is disabled and every return value kept alive, and only
+    objects that did not exist before are counted, so objects freed by the
+    calls cannot make up for new ones. What a call returns and the reference
+    cycles it creates are counted; temporaries freed by reference counting
+    during the call are not, so benchmarked functions return what they
+    build. The value is approximate: a temporary's address may be reused by
+    a later container, which is counted once.
+    >>> count_allocations(lambda: [{'tags': []}], 100)
+    3.0
+    >>> count_allocations(lambda: None)
+    0.0
+    >>> count_allocations(lambda: [], overhead=1)
+    0.0
+    >>> garbage = [[] for i in xrange(1000)]
+    >>> count_allocations(lambda: garbage.pop(), 100)
+    0.0
+    '''
+    keep = []
+    gc.collect()
+    gc.disable()
+    try:
+        before = set(id(o) for o in gc.get_objects())
+        for i in xrange(number):
+            keep.append(fn())
+        after = gc.get_objects()
+    finally:
+        gc.enable()
+    # minus the set of ids itself:
+    new = len([o for o in after if id(o) not in before]) - 1
+    return max(float(new) / number - overhead, 0.0)
+
+
+def measure(fn, number=10000, warmup=200):
+    '''
+    Call fn() number times and return a dict of req/s, latency percentiles
+    in microseconds and allocations per call (measured on up to 1000 more
+    calls).
+    '''
+    for i in xrange(warmup):
+        fn()
+    timer = timeit.default_timer
+    samples = [0.0] * number
+    gc.collect()
+    start = timer()
+    for i in xrange(number):
+        t = timer()
+        fn()
+        samples[i] = timer() - t
+    total = timer() - start
+    samples.sort()
+    return dict(
+        number=number,
+        requests_per_sec=round(number / total, 1),
+        mean_us=round(sum(samples) / number * 1e6, 2),
+        p50_us=round(percentile(samples, 50) * 1e6, 2),
+        p99_us=round(percentile(samples, 99) * 1e6, 2),
+        allocations_per_call=round(count_allocations(fn, min(number, 1000)), 3))
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def report(results):
+    return dict(
+        revision=_git_revision(),
+        time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        max_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        results=results)
+
+
+def save(data, path):
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def print_results(results, baseline=None):
+    base = baseline['results'] if baseline else {}
+    print '%-28s %12s %10s %10s %10s' % ('benchmark', 'req/s', 'p50 us', 'p99 us', 'allocs~')
+    for name in sorted(results):
+        r = results[name]
+        line = '%-28s %12.1f %10.2f %10.2f %10.3f' % (name, r['requests_per_sec'], r['p50_us'], r['p99_us'], r['allocations_per_call'])
+        if name in base:
+            line = line + '   %+6.1f%% req/s' % ((r['requests_per_sec'] / base[name]['requests_per_sec'] - 1) * 100)
+        print line
+    sys.stdout.flush()
@@ -1,17 +1,26 @@
 # -*- coding: utf-8 -*-
-from core.utils import Dict
+from core.utils import Dict, LRUCache
+from core import multipart
 import types
 import os
 import re
-import cgi
 import sys
+import json
+import stat
+import time
 import datetime
 import functools
 import mimetypes
 import threading
 import logging
 import urllib
+import urlparse
 import traceback
+import zlib
+import mmap
+import struct
+import hashlib
+import email.utils
 
 try:
     from cStringIO import StringIO
@@ -388,7 +397,12 @@ class Route(object):
         self.is_static = _re_route.search(self.path) is None
         if not self.is_static:
             self.route = re.compile(_build_regex(self.path))
+            parts = _re_route.split(self.path)
+            self.prefix = parts[0]
+            self.suffix = parts[-1]
         self.func = func
+        self.interceptors = ()
+        self.chain = self
 
     def match(self, url):
         m = self.route.match(url)
@@ -406,34 +420,376 @@ class Route(object):
 
     __repr__ = __str__
 
+_RE_ROUTE_PARAM = re.compile(r'^\:[a-zA-Z_]\w*$')
 
-def _static_file_generator(fpath):
+
+class _TrieNode(object):
+    '''
+    One path segment of the dynamic route trie.
+    '''
+    __slots__ = ('children', 'param', 'patterns', 'route', 'index', 'min_index')
+
+    def __init__(self):
+        self.children = {}
+        self.param = None
+        self.patterns = []
+        self.route = None
+        self.index = sys.maxint
+        self.min_index = sys.maxint
+
+
+class _Dispatcher(object):
+    '''
+    Dispatcher of dynamic routes, built once when the application is frozen.
+
+    Routes are stored in a path-segment trie so the lookup cost depends on
+    the depth of the path instead of the number of routes. Each node keeps
+    the smallest registration index of its subtree, and the first registered
+    route that matches still wins, exactly like the linear scan.
+    Objects that are not a Route (e.g. StaticFileRoute) only provide match()
+    and are kept in a short fallback list.
+
+    >>> paths = ['/blog/:id', '/:name/:id', '/blog/:id-:page']
+    >>> d = _Dispatcher([Route(get(p)(lambda: None)) for p in paths])
+    >>> d.match('/blog/123')
+    (Route(dynamic, GET, path=/blog/:id), ('123',))
+    >>> d.match('/user/123')
+    (Route(dynamic, GET, path=/:name/:id), ('user', '123'))
+    >>> d.match('/blog/1-2')
+    (Route(dynamic, GET, path=/blog/:id), ('1-2',))
+    >>> d.match('/blog/')
+    (None, None)
+    '''
+    def __init__(self, routes):
+        self._root = _TrieNode()
+        self._fallbacks = []
+        for index, route in enumerate(routes):
+            if isinstance(route, Route):
+                self._add(index, route)
+            else:
+                self._fallbacks.append((index, route))
+
+    def _add(self, index, route):
+        node = self._root
+        node.min_index = min(node.min_index, index)
+        for seg in route.path.split('/'):
+            if _RE_ROUTE_PARAM.match(seg):
+                if node.param is None:
+                    node.param = _TrieNode()
+                node = node.param
+            elif _re_route.search(seg):
+                for key, regex, child in node.patterns:
+                    if key == seg:
+                        break
+                else:
+                    child = _TrieNode()
+                    node.patterns.append((seg, re.compile(_build_regex(seg)), child))
+                node = child
+            else:
+                node = node.children.setdefault(seg, _TrieNode())
+            node.min_index = min(node.min_index, index)
+        if index < node.index:
+            node.route = route
+            node.index = index
+
+    def _walk(self, node, segs, i, args, best):
+        if node.min_index >= best[0]:
+            return
+        if i == len(segs):
+            if node.index < best[0]:
+                best[:] = [node.index, node.route, tuple(args)]
+            return
+        seg = segs[i]
+        child = node.children.get(seg)
+        if child is not None:
+            self._walk(child, segs, i + 1, args, best)
+        if not seg:
+            return
+        if node.param is not None:
+            args.append(seg)
+            self._walk(node.param, segs, i + 1, args, best)
+            args.pop()
+        for key, regex, child in node.patterns:
+            m = regex.match(seg)
+            if m:
+                groups = m.groups()
+                args.extend(groups)
+                self._walk(child, segs, i + 1, args, best)
+                del args[-len(groups):]
+
+    def match(self, url):
+        '''
+        Return (route, args) of the first registered matching route, or (None, None).
+        '''
+        best = [sys.maxint, None, None]
+        self._walk(self._root, url.split('/'), 0, [], best)
+        for index, route in self._fallbacks:
+            if index >= best[0]:
+                break
+            args = route.match(url)
+            if args:
+                return route, args
+        if best[1] is None:
+            return None, None
+        return best[1], best[2]
+
+
+def _static_file_generator(fpath, offset=0, length=None):
     BLOCK_SIZE = 8192
     with open(fpath, 'rb') as f:
-        block = f.read(BLOCK_SIZE)
-        while block:
+        if offset:
+            f.seek(offset)
+        remaining = length
+        while remaining is None or remaining > 0:
+            size = BLOCK_SIZE if remaining is None else min(BLOCK_SIZE, remaining)
+            block = f.read(size)
+            if not block:
+                break
+            if remaining is not None:
+                remaining = remaining - len(block)
             yield block
-            block = f.read(BLOCK_SIZE)
+
+
+def _http_date(t):
+    return email.utils.formatdate(t, usegmt=True)
+
+
+def _parse_http_date(s):
+    t = email.utils.parsedate_tz(s)
+    if t is None:
+        return None
+    return email.utils.mktime_tz(t)
+
+_RE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def _parse_range(value, size):
+    '''
+    Parse a single byte range and return (start, end) inclusive, None if the
+    header is ignored, or False if the range cannot be satisfied.
+    >>> _parse_range('bytes=0-99', 1000)
+    (0, 99)
+    >>> _parse_range('bytes=900-', 1000)
+    (900, 999)
+    >>> _parse_range('bytes=-100', 1000)
+    (900, 999)
+    >>> _parse_range('bytes=1000-', 1000)
+    False
+    >>> _parse_range('bytes=0-1,5-6', 1000) is None
+    True
+    '''
+    m = _RE_RANGE.match(value.strip())
+    if not m:
+        return None
+    first, last = m.groups()
+    if not first:
+        if not last:
+            return None
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+
+def _accept_encodings(request):
+    '''
+    Return the content codings accepted by the client as a set.
+    >>> sorted(_accept_encodings(Request({'HTTP_ACCEPT_ENCODING': 'gzip;q=1.0, deflate;q=0, br'}))) == ['br', 'gzip']
+    True
+    '''
+    value = request.header('Accept-Encoding')
+    if not value:
+        return set()
+    accepted = set()
+    for item in value.split(','):
+        parts = item.split(';')
+        coding = parts[0].strip().lower()
+        q = 1.0
+        for param in parts[1:]:
+            k, _, v = param.partition('=')
+            if k.strip() == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        if coding and q > 0:
+            accepted.add(coding)
+    return accepted
+
+
+def _add_vary(response, name):
+    vary = response.header('Vary')
+    if not vary:
+        response.set_header('Vary', name)
+    elif name.lower() not in [v.strip().lower() for v in vary.split(',')]:
+        response.set_header('Vary', '%s, %s' % (vary, name))
+
+
+def _static_file_path(static_root, name):
+    '''
+    Return the real path of name under static_root (a real path ending with
+    os.sep), or None when it resolves outside of it. The request path is
+    unquoted once, so %2e%2e segments arrive here as ..:
+    >>> _static_file_path('/srv/static/', 'css/site.css')
+    '/srv/static/css/site.css'
+    >>> _static_file_path('/srv/static/', '../settings/config_override.py') is None
+    True
+    >>> _static_file_path('/srv/static/', urllib.unquote('%2e%2e/manage.py')) is None
+    True
+    >>> _static_file_path('/srv/static/', 'js/../../static-old/x.js') is None
+    True
+    >>> _static_file_path('/srv/static/', '/etc/passwd') is None
+    True
+    '''
+    fpath = os.path.realpath(os.path.join(static_root, name))
+    if not fpath.startswith(static_root):
+        return None
+    return fpath
 
 
 class StaticFileRoute(object):
-    def __init__(self):
+    '''
+    Serve files under document_root/static/.
+
+    Small files are kept in an LRU cache invalidated by mtime; larger ones go
+    through wsgi.file_wrapper when the server offers it. Responses carry
+    Content-Length, ETag and Last-Modified, answer conditional requests with
+    304 and support a single byte range. With precompressed enabled, a
+    sibling .gz file is sent as-is to clients accepting gzip; a missing one
+    is remembered in the cache until the file changes.
+    '''
+    BLOCK_SIZE = 8192
+
+    def __init__(self, cache_size=256, cache_file_size=65536, check_interval=1.0, max_age=None, precompressed=True):
         self.method = 'GET'
         self.is_static = False
         self.route = re.compile('^/static/(.+)$')
+        self.prefix = '/static/'
+        self.suffix = ''
+        self.interceptors = ()
+        self.chain = self
+        self._cache = LRUCache(cache_size)
+        self._cache_file_size = cache_file_size
+        self._check_interval = check_interval
+        self._max_age = max_age
+        self._precompressed = precompressed
+        self._root = None
 
     def match(self, url):
         if url.startswith('/static/'):
-            return (url[1:], )
+            return (url[8:], )
         return None
 
+    def _stat(self, fpath):
+        '''
+        Return (mtime, size, data) where data is the cached content of a small file.
+        '''
+        now = time.time()
+        entry = self._cache.get(fpath)
+        if entry and now - entry[0] < self._check_interval:
+            return entry[1:]
+        try:
+            st = os.stat(fpath)
+        except OSError:
+            raise notfound()
+        if not stat.S_ISREG(st.st_mode):
+            raise notfound()
+        mtime, size = int(st.st_mtime), st.st_size
+        if entry and entry[1] == mtime and entry[2] == size:
+            self._cache[fpath] = (now, ) + entry[1:]
+            return entry[1:]
+        data = None
+        if size <= self._cache_file_size:
+            with open(fpath, 'rb') as f:
+                data = f.read()
+            self._cache[fpath] = (now, mtime, size, data)
+        else:
+            self._cache.pop(fpath)
+        return mtime, size, data
+
+    def _stat_precompressed(self, fpath, mtime):
+        '''
+        Return _stat() of the .gz sibling of fpath, or None when there is
+        none. A miss is cached as (None, mtime) until the source mtime changes.
+        '''
+        gz = fpath + '.gz'
+        missing = (None, mtime)
+        entry = self._cache.get(gz)
+        if entry == missing:
+            return None
+        if entry and entry[0] is None:
+            self._cache.pop(gz)
+        try:
+            return self._stat(gz)
+        except HttpError:
+            self._cache[gz] = missing
+            return None
+
     def __call__(self, *args):
-        fpath = os.path.join(ctx.application.document_root, args[0])
-        if not os.path.isfile(fpath):
+        root = self._root
+        if root is None:
+            root = self._root = os.path.join(os.path.realpath(os.path.join(ctx.application.document_root, 'static')), '')
+        fpath = _static_file_path(root, args[0])
+        if fpath is None:
             raise notfound()
+        mtime, size, data = self._stat(fpath)
+        request = ctx.request
+        response = ctx.response
         fext = os.path.splitext(fpath)[1]
-        ctx.response.content_type = mimetypes.types_map.get(fext.lower(), 'application/octet-stream')
-        return _static_file_generator(fpath)
+        response.content_type = mimetypes.types_map.get(fext.lower(), 'application/octet-stream')
+        etag = '"%x-%x"' % (mtime, size)
+        if self._precompressed:
+            _add_vary(response, 'Accept-Encoding')
+            if 'gzip' in _accept_encodings(request):
+                gz = self._stat_precompressed(fpath, mtime)
+                if gz:
+                    mtime, size, data = gz
+                    fpath = fpath + '.gz'
+                    etag = '"%x-%x-gz"' % (mtime, size)
+                    response.set_header('Content-Encoding', 'gzip')
+        response.set_header('ETag', etag)
+        response.set_header('Last-Modified', _http_date(mtime))
+        response.set_header('Accept-Ranges', 'bytes')
+        if self._max_age is not None:
+            response.set_header('Cache-Control', 'max-age=%d' % self._max_age)
+        if self._not_modified(request, etag, mtime):
+            response.status = 304
+            return []
+        offset, length = 0, size
+        range_header = request.header('Range')
+        if range_header and request.header('If-Range', etag) in (etag, _http_date(mtime)):
+            r = _parse_range(range_header, size)
+            if r is False:
+                response.status = 416
+                response.set_header('Content-Range', 'bytes */%d' % size)
+                response.content_length = 0
+                return []
+            if r:
+                offset, length = r[0], r[1] - r[0] + 1
+                response.status = 206
+                response.set_header('Content-Range', 'bytes %d-%d/%d' % (r[0], r[1], size))
+        response.content_length = length
+        if data is not None:
+            return [data[offset:offset + length]]
+        if offset == 0 and length == size:
+            file_wrapper = request.environ.get('wsgi.file_wrapper')
+            if file_wrapper:
+                return file_wrapper(open(fpath, 'rb'), self.BLOCK_SIZE)
+        return _static_file_generator(fpath, offset, length)
+
+    def _not_modified(self, request, etag, mtime):
+        if request.header('If-None-Match'):
+            return _etag_matches(request, etag)
+        if_modified_since = request.header('If-Modified-Since')
+        if if_modified_since:
+            t = _parse_http_date(if_modified_since)
+            return t is not None and mtime <= t
+        return False
 
 '''
 def favicon_handler():
@@ -453,25 +809,107 @@ class MultipartFile(object):
         self.file = storage.file
 
 
+_json_loads = json.loads
+
+
+def set_json_decoder(loads):
+    '''
+    Use another decoder for JSON request bodies, e.g. set_json_decoder(ujson.loads).
+    '''
+    global _json_loads
+    _json_loads = loads
+
+
+def _is_json(content_type):
+    return content_type == 'application/json' or content_type.endswith('+json')
+
+
+def _add_input(inputs, name, value):
+    if name in inputs:
+        old = inputs[name]
+        if isinstance(old, list):
+            old.append(value)
+        else:
+            inputs[name] = [old, value]
+    else:
+        inputs[name] = value
+
+
 class Request(object):
+    '''
+    Wrapper of the WSGI environ. Path, headers and cookies are parsed once on
+    first access; __dict__ is kept so handlers can attach attributes such as
+    request.user.
+    '''
+    __slots__ = ('_environ', '_path_info', '_headers', '_cookies', '_query', '_raw_input', '_body', '_json', '__dict__')
+
+    # limits of form bodies, uploads larger than SPOOL_SIZE go to temp files:
+    MAX_BODY_SIZE = 16 * 1024 * 1024
+    MAX_FIELD_SIZE = 1024 * 1024
+    MAX_FIELDS = 1000
+    SPOOL_SIZE = 256 * 1024
+
     def __init__(self, environ):
         self._environ = environ
+        self._path_info = None
+        self._headers = None
+        self._cookies = None
+
+    def _get_query(self):
+        '''
+        Get query string arguments as dict containing values as unicode or list
+        '''
+        if not hasattr(self, '_query'):
+            inputs = dict()
+            for name, value in urlparse.parse_qsl(self.query_string, keep_blank_values=True):
+                _add_input(inputs, name, _to_unicode(value))
+            self._query = inputs
+        return self._query
+
+    def _parse_body(self):
+        environ = self._environ
+        if environ['REQUEST_METHOD'] in ('GET', 'HEAD'):
+            return ()
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            raise badrequest()
+        if length <= 0:
+            return ()
+        content_type, options = multipart.parse_options_header(environ.get('CONTENT_TYPE', ''))
+        if _is_json(content_type):
+            return self._json_items()
+        fp = environ['wsgi.input']
+        if content_type == 'multipart/form-data':
+            return multipart.parse_multipart(fp, length, options.get('boundary'), self.MAX_BODY_SIZE, self.MAX_FIELD_SIZE, self.MAX_FIELDS, self.SPOOL_SIZE)
+        if content_type in ('', 'application/x-www-form-urlencoded'):
+            return multipart.parse_urlencoded(fp, length, self.MAX_BODY_SIZE, self.MAX_FIELD_SIZE, self.MAX_FIELDS)
+        return ()
+
+    def _json_items(self):
+        # a JSON list is one value, wrap it so it is not taken as repeated fields:
+        obj = self.json
+        if not isinstance(obj, dict):
+            return ()
+        return [(k, [v] if isinstance(v, list) else v, None) for k, v in obj.iteritems()]
 
     def _parse_input(self):
-        def _convert(item):
-            if isinstance(item, list):
-                return [_to_unicode[i.value] for i in item]
-            if item.filename:
-                return MultipartFile(item)
-            return _to_unicode(item.value)
-        fs = cgi.FieldStorage(
-            fp=self._environ['wsgi.input'],
-            environ=self._environ,
-            keep_blank_values=True
-        )
-        inputs = dict()
-        for key in fs:
-            inputs[key] = _convert(fs[key])
+        query = self._get_query()
+        inputs = dict((k, v[:] if isinstance(v, list) else v) for k, v in query.iteritems())
+        try:
+            for name, value, filename in self._parse_body():
+                if filename is None:
+                    if isinstance(value, str):
+                        value = _to_unicode(value)
+                else:
+                    value = MultipartFile(Dict(filename=filename, file=value))
+                _add_input(inputs, name, value)
+        except multipart.BodyTooLargeError, e:
+            logging.warning('reject request body: %s' % e)
+            raise HttpError(413)
+        except (multipart.MultipartError, UnicodeDecodeError), e:
+            logging.warning('bad request body: %s' % e)
+            raise badrequest()
         return inputs
 
     def _get_raw_input(self):
@@ -479,7 +917,10 @@ class Request(object):
         Get raw input as dict containing values as unicode, list or MultipartFile
         '''
         if not hasattr(self, '_raw_input'):
-            self._raw_input = self._parse_input()
+            if self._environ['REQUEST_METHOD'] in ('GET', 'HEAD'):
+                self._raw_input = self._get_query()
+            else:
+                self._raw_input = self._parse_input()
         return self._raw_input
 
     def __getitem__(self, key):
@@ -508,8 +949,33 @@ class Request(object):
         return copy
 
     def get_body(self):
-        fp = self._environ['wsgi.input']
-        return fp.read()
+        '''
+        Read CONTENT_LENGTH bytes of the request body once and return them as str.
+        '''
+        if not hasattr(self, '_body'):
+            try:
+                length = int(self._environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                raise badrequest()
+            if length > self.MAX_BODY_SIZE:
+                raise HttpError(413)
+            self._body = self._environ['wsgi.input'].read(length) if length > 0 else ''
+        return self._body
+
+    @property
+    def json(self):
+        '''
+        Decoded JSON body, or None if the body is empty or not JSON.
+        '''
+        if not hasattr(self, '_json'):
+            content_type = multipart.parse_options_header(self._environ.get('CONTENT_TYPE', ''))[0]
+            body = self.get_body() if _is_json(content_type) else ''
+            try:
+                self._json = _json_loads(body) if body else None
+            except ValueError, e:
+                logging.warning('bad json body: %s' % e)
+                raise badrequest()
+        return self._json
 
     @property
     def remote_addr(self):
@@ -533,14 +999,16 @@ class Request(object):
 
     @property
     def path_info(self):
-        return urllib.unquote(self._environ.get('PATH_INFO', ''))
+        if self._path_info is None:
+            self._path_info = urllib.unquote(self._environ.get('PATH_INFO', ''))
+        return self._path_info
 
     @property
     def host(self):
         return self._environ.get('HTTP_HOST', '')
 
     def _get_headers(self):
-        if not hasattr(self, '_headers'):
+        if self._headers is None:
             hdrs = {}
             for k, v in self._environ.iteritems():
                 if k.startswith('HTTP_'):
@@ -551,14 +1019,17 @@ class Request(object):
 
     @property
     def headers(self):
-        return dict(**self._get_headers())
+        '''
+        Request headers as dict, parsed once and shared: do not modify.
+        '''
+        return self._get_headers()
 
     def header(self, header, default=None):
         return self._get_headers().get(header.upper(), default)
 
     def _get_cookies(self):
-        if not hasattr(self, '_cookies'):
-            cookies = {}
+        if self._cookies is None:
+            cookies = Dict()
             cookie_str = self._environ.get('HTTP_COOKIE')
             if cookie_str:
                 for c in cookie_str.split(';'):
@@ -570,7 +1041,10 @@ class Request(object):
 
     @property
     def cookies(self):
-        return Dict(**self._get_cookies())
+        '''
+        Request cookies as Dict, parsed once and shared: do not modify.
+        '''
+        return self._get_cookies()
 
     def cookie(self, name, default=None):
         return self._get_cookies().get(name, default)
@@ -578,38 +1052,55 @@ class Request(object):
 UTC_0 = UTC('+00:00')
 
 
+def _response_header_key(name):
+    key = name.upper()
+    if key in _RESPONSE_HEADER_DICT:
+        return key, _RESPONSE_HEADER_DICT[key]
+    return name, name
+
+_HEADER_CONTENT_TYPE_HTML = ('Content-Type', 'text/html; charset=utf-8')
+
+# shared by every response until it sets its own headers:
+_DEFAULT_RESPONSE_HEADERS = {'CONTENT-TYPE': _HEADER_CONTENT_TYPE_HTML}
+
+
 class Response(object):
+    '''
+    Response status, headers and cookies. Headers are stored as ready to
+    send (name, value) pairs, so building the header list is a plain copy.
+    '''
+    __slots__ = ('_status', '_headers', '_cookies')
+
     def __init__(self):
-        self.status = '200 OK'
-        self._headers = {'CONTENT-TYPE': 'text/html; charset=utf-8'}
+        self._status = '200 OK'
+        self._headers = _DEFAULT_RESPONSE_HEADERS
+        self._cookies = None
 
     @property
     def headers(self):
-        L = [(_RESPONSE_HEADER_DICT.get(k, k), v) for k, v in self._headers.iteritems()]
-        if hasattr(self, '_cookies'):
+        L = self._headers.values()
+        if self._cookies:
             for v in self._cookies.itervalues():
                 L.append(('Set-Cookie', v))
         L.append(_HEADER_X_POWERED_BY)
         return L
 
     def header(self, name):
-        key = name.upper()
-        if not key in _RESPONSE_HEADER_DICT:
-            key = name
-        return self._headers.get(key)
+        h = self._headers.get(_response_header_key(name)[0])
+        return h[1] if h else None
 
     def unset_header(self, name):
-        key = name.upper()
-        if not key in _RESPONSE_HEADER_DICT:
-            key = name
+        key = _response_header_key(name)[0]
         if key in self._headers:
+            if self._headers is _DEFAULT_RESPONSE_HEADERS:
+                self._headers = dict(_DEFAULT_RESPONSE_HEADERS)
             del self._headers[key]
 
     def set_header(self, name, value):
-        key = name.upper()
-        if not key in _RESPONSE_HEADER_DICT:
-            key = name
-        self._headers[key] = _to_str(value)
+        key, name = _response_header_key(name)
+        if self._headers is _DEFAULT_RESPONSE_HEADERS:
+            self._headers = dict(_DEFAULT_RESPONSE_HEADERS)
+        self._headers[key] = (name, _to_str(value))
 
     @property
     def content_type(self):
@@ -620,7 +1111,7 @@ class Response(object):
         if value:
             self.set_header('CONTENT-TYPE', value)
         else:
-            self.unset_headers('CONTENT-TYPE')
+            self.unset_header('CONTENT-TYPE')
 
     @property
     def content_length(self):
@@ -628,13 +1119,13 @@ class Response(object):
 
     @content_length.setter
     def content_length(self, value):
-        self.set_header('CONTENT-LENGHT', str(value))
+        self.set_header('CONTENT-LENGTH', str(value))
 
     def delete_cookie(self, name):
         self.set_cookie(name, '__deleted__', expires=0)
 
     def set_cookie(self, name, value, max_age=None, expires=None, path='/', domain=None, secure=False, http_only=True):
-        if not hasattr(self, '_cookies'):
+        if self._cookies is None:
             self._cookies = {}
         L = ['%s=%s' % (_quote(name), _quote(value))]
         if expires is not None:
@@ -644,7 +1135,7 @@ class Response(object):
                 L.append('Expires=%s' % expires.astimezone(UTC_0).strftime('%a, %d-%b-%Y %H:%M:%S GMT'))
         elif isinstance(max_age, (int, long)):
             L.append('Max-Age=%d' % max_age)
-        L.append('Path=%s', path)
+        L.append('Path=%s' % path)
         if domain:
             L.append('Domain=%s' % domain)
         if secure:
@@ -654,7 +1145,7 @@ class Response(object):
         self._cookies[name] = '; '.join(L)
 
     def unset_cookie(self, name):
-        if hasattr(self, '_cookies'):
+        if self._cookies:
             if name in self._cookies:
                 del self._cookies[name]
 
@@ -700,17 +1191,127 @@ class TemplateEngine(object):
 
 
 class Jinja2TemplateEngine(TemplateEngine):
-    def __init__(self, tml_dir, **kwargs):
-        from jinja2 import Enviroment, FileSystemLoader
+    '''
+    Render templates under tml_dir with Jinja2.
+
+    In production mode templates are not checked for changes, compiled
+    templates are never evicted and their bytecode is kept in cache_dir
+    (default: a per-user temp directory), so processes started after a
+    deploy load bytecode instead of compiling. Call precompile() once the
+    filters are added to compile every template before serving.
+    The {% cache key, ttl %} tag is always available, see core.jinja2ext.
+
+    With streaming enabled, templates are rendered into an iterator of utf-8
+    chunks of about buffer_size characters (see stream()), which the server
+    sends while the rest of the page is being rendered.
+
+    Jinja2 is imported and the environment built on first use, so a process
+    that does not render templates does not pay for them.
+    '''
+    def __init__(self, tml_dir, production=False, cache_dir=None, streaming=False, buffer_size=8192, **kwargs):
         if not 'autoescape' in kwargs:
             kwargs['autoescape'] = True
-        self._env = Enviroment(loader=FileSystemLoader(tml_dir), **kwargs)
+        if production:
+            kwargs.setdefault('auto_reload', False)
+            kwargs.setdefault('cache_size', -1)
+        kwargs['extensions'] = list(kwargs.get('extensions', ())) + ['core.jinja2ext.FragmentCacheExtension']
+        self._tml_dir = tml_dir
+        self._production = production
+        self._cache_dir = cache_dir
+        self._kwargs = kwargs
+        self._filters = {}
+        self._env = None
+        self._lock = threading.Lock()
+        self._streaming = streaming
+        self._buffer_size = buffer_size
+
+    @property
+    def environment(self):
+        env = self._env
+        if env is None:
+            with self._lock:
+                if self._env is None:
+                    self._env = self._create_environment()
+                env = self._env
+        return env
+
+    def _create_environment(self):
+        from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+        kwargs = dict(self._kwargs)
+        if self._production and not 'bytecode_cache' in kwargs:
+            kwargs['bytecode_cache'] = FileSystemBytecodeCache(self._cache_dir) if self._cache_dir else FileSystemBytecodeCache()
+        env = Environment(loader=FileSystemLoader(self._tml_dir), **kwargs)
+        env.filters.update(self._filters)
+        return env
+
+    @property
+    def fragment_cache(self):
+        return self.environment.fragment_cache
 
     def add_filter(self, name, fn_filter):
-        self._env.filter[name] = fn_filter
+        self._filters[name] = fn_filter
+        if self._env is not None:
+            self._env.filters[name] = fn_filter
+
+    def precompile(self):
+        '''
+        Load every template so it is compiled (or read from the bytecode
+        cache) now rather than on its first request. Return the count.
+        '''
+        start = time.time()
+        env = self.environment
+        names = env.list_templates(filter_func=lambda name: not os.path.basename(name).startswith('.'))
+        for name in names:
+            env.get_template(name)
+        logging.info('Precompiled %d templates in %.3fs' % (len(names), time.time() - start))
+        return len(names)
+
+    def stream(self, path, model):
+        '''
+        Render into a generator of utf-8 chunks. The first chunk is rendered
+        before returning, so an error at the top of the template still ends
+        in the 500 page; a later error is logged and aborts the response.
+        The request context stays available until the body is closed.
+        Streamed bodies have no Content-Length and are not compressed.
+        '''
+        chunks = _buffered_chunks(self.environment.get_template(path).generate(**model), self._buffer_size)
+        first = next(chunks, None)
+        return _prepend_chunk(first, chunks)
 
     def __call__(self, path, model):
-        return self._env.get_template(path).render(**model).encode('utf-8')
+        if self._streaming:
+            return self.stream(path, model)
+        return self.environment.get_template(path).render(**model).encode('utf-8')
+
+
+def _buffered_chunks(events, buffer_size):
+    r'''
+    Join the small unicode strings of a template generator into utf-8
+    chunks of at least buffer_size characters.
+    >>> list(_buffered_chunks(iter([u'ab', u'c', u'\u4e2d', u'd']), 3))
+    ['abc', '\xe4\xb8\xadd']
+    '''
+    buf = []
+    size = 0
+    for s in events:
+        buf.append(s)
+        size = size + len(s)
+        if size >= buffer_size:
+            yield u''.join(buf).encode('utf-8')
+            buf = []
+            size = 0
+    if buf:
+        yield u''.join(buf).encode('utf-8')
+
+
+def _prepend_chunk(first, chunks):
+    try:
+        if first is not None:
+            yield first
+        for chunk in chunks:
+            yield chunk
+    finally:
+        chunks.close()
 
 
 def _debug():
@@ -743,6 +1344,243 @@ def view(path):
         return _wrapper
     return _decorate
 
+class TableVersions(object):
+    '''
+    Version tokens of tables, replaced by a random value whenever a table
+    changes. The tokens live in anonymous shared memory mapped when the
+    object is created, so processes forked afterwards (the PreforkServer
+    workers) see each other's changes. Every slot starts random, so a
+    restart or deploy never reuses the versions of the previous one. Tables
+    share the slots by hash, a collision only costs a spurious change.
+    >>> v = TableVersions()
+    >>> v.get('blogs') == TableVersions().get('blogs')
+    False
+    >>> before = v.get('blogs', 'users')
+    >>> v.bump('blogs')
+    >>> after = v.get('blogs', 'users')
+    >>> after[0] != before[0], after[1] == before[1]
+    (True, True)
+    '''
+    def __init__(self, slots=1024):
+        self._slots = slots
+        self._mem = mmap.mmap(-1, slots * 8)
+        self._mem.write(os.urandom(slots * 8))
+
+    def _offset(self, table):
+        return (zlib.crc32(table) % self._slots) * 8
+
+    def get(self, *tables):
+        return tuple(struct.unpack_from('Q', self._mem, self._offset(t))[0] for t in tables)
+
+    def bump(self, *tables):
+        for t in tables:
+            struct.pack_into('Q', self._mem, self._offset(t), struct.unpack('Q', os.urandom(8))[0])
+
+_table_versions = TableVersions()
+
+
+def table_version(*tables):
+    '''
+    Return the current version tokens of tables, which change whenever
+    invalidate_pages() is called for one of them, in any worker process,
+    and on every start. Writes made outside the ORM or by another server
+    are not seen.
+    '''
+    return _table_versions.get(*tables)
+
+
+class PageCache(object):
+    '''
+    Bounded LRU store of rendered pages. Each page keeps the versions of the
+    tables it was built from and is dropped on get() when one of them has
+    changed, so invalidation reaches every process sharing the versions.
+    '''
+    def __init__(self, capacity=1024, versions=None):
+        self._store = LRUCache(capacity)
+        self.versions = _table_versions if versions is None else versions
+
+    def get(self, key):
+        entry = self._store.get(key)
+        if entry is None:
+            return None
+        if entry.expires < time.time() or (entry.tables and self.versions.get(*entry.tables) != entry.versions):
+            self._store.pop(key)
+            return None
+        return entry
+
+    def set(self, key, entry, tables=(), versions=None):
+        '''
+        Store entry, versions are the ones of tables read before the page
+        was built (default: now).
+        '''
+        entry.tables = tuple(tables)
+        entry.versions = self.versions.get(*tables) if versions is None else versions
+        self._store[key] = entry
+
+    def invalidate(self, *tables):
+        self.versions.bump(*tables)
+
+    def clear(self):
+        self._store.clear()
+
+_page_cache = PageCache()
+
+
+def invalidate_pages(*tables):
+    '''
+    Drop every cached page built from one of the tables, in this process and
+    in the workers forked from it. Can be registered as an ORM change listener:
+    orm.add_change_listener(invalidate_pages)
+    Changes made outside the ORM (or by another server) are only seen when
+    the pages expire.
+    '''
+    logging.info('invalidate cached pages of %s' % ', '.join(tables))
+    _table_versions.bump(*tables)
+
+
+def cache_page(ttl=60, vary=(), cookies=(), tables=(), cache=None):
+    '''
+    A @cache_page decorator that stores the rendered body and headers of a
+    @view or @get handler, keyed by method, path, query string and the given
+    request headers and cookies. Responses setting cookies are not cached.
+    @cache_page(ttl=30, tables=('blogs', ))
+    @view('blogs.html')
+    @get('/')
+    def index():
+        pass
+    '''
+    def _decorate(func):
+        @functools.wraps(func)
+        def _wrapper(*args, **kwargs):
+            store = _page_cache if cache is None else cache
+            request = ctx.request
+            response = ctx.response
+            key = (request.request_method, request.path_info, request.query_string,
+                   tuple(request.header(h) for h in vary), tuple(request.cookie(c) for c in cookies))
+            entry = store.get(key)
+            if entry:
+                response.status = entry.status
+                for name, value in entry.headers:
+                    response.set_header(name, value)
+                return entry.body
+            versions = store.versions.get(*tables)
+            r = func(*args, **kwargs)
+            if isinstance(r, Template):
+                r = ctx.application.template_engine(r.template_name, r.model)
+            if isinstance(r, types.GeneratorType):
+                r = ''.join(r)
+            if isinstance(r, unicode):
+                r = r.encode('utf-8')
+            if isinstance(r, str) and response.status_code == 200 and not response._cookies:
+                headers = response._headers.values()
+                store.set(key, Dict(expires=time.time() + ttl, status=response.status, headers=headers, body=r), tables, versions)
+            return r
+        return _wrapper
+    return _decorate
+
+# new on every start, so the version keyed ETags of another boot or deploy
+# never match, whatever their version values:
+_BOOT_ID = os.urandom(8).encode('hex')
+
+
+def _opaque_tag(tag):
+    '''
+    >>> _opaque_tag('W/"abc"'), _opaque_tag('"abc-gz"')
+    ('"abc"', '"abc"')
+    '''
+    if tag.startswith('W/'):
+        tag = tag[2:]
+    if tag.endswith('-gz"'):
+        tag = tag[:-4] + '"'
+    return tag
+
+
+def _etag_matches(request, etag):
+    '''
+    Weak comparison of If-None-Match with etag (RFC 7232). The -gz suffix
+    of compressed representations is ignored as the body is the same.
+    '''
+    if_none_match = request.header('If-None-Match')
+    if not if_none_match:
+        return False
+    opaque = _opaque_tag(etag)
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag == '*' or _opaque_tag(tag) == opaque:
+            return True
+    return False
+
+
+def _not_modified(response, etag):
+    response.status = 304
+    response.set_header('ETag', etag)
+    response.unset_header('Content-Length')
+    return []
+
+
+def _make_etag(data, weak):
+    tag = '"%s"' % hashlib.md5(data).hexdigest()
+    return 'W/' + tag if weak else tag
+
+
+def _etag_response(r, options):
+    '''
+    Tag a fully buffered 200 response with the hash of its body, unless the
+    handler set an ETag, and turn it into a 304 when If-None-Match matches.
+    '''
+    response = ctx.response
+    if response.status_code != 200:
+        return r
+    tag = response.header('ETag')
+    if tag is None:
+        if isinstance(r, list) and all(isinstance(x, str) for x in r):
+            r = ''.join(r)
+        if not isinstance(r, str):
+            return r
+        tag = _make_etag(r, options.weak)
+        response.set_header('ETag', tag)
+    if _etag_matches(ctx.request, tag):
+        return _not_modified(response, tag)
+    return r
+
+
+def etag(version, weak=True, vary=(), cookies=()):
+    '''
+    A @etag decorator deriving the ETag of a GET handler from a cheap
+    version key instead of the body. version is called with the handler
+    arguments; its value is hashed with the path, query string, the given
+    request headers and cookies and an id of the current boot, so a restart
+    or deploy always changes the tag. A matching If-None-Match is answered with
+    304 before the handler runs, so neither the main query nor the template
+    is executed, so version must not query the database either; the
+    in-memory table_version() fits. Put it above @cache_page and @view:
+    @etag(lambda: table_version('blogs'))
+    @view('blogs.html')
+    @get('/')
+    def index():
+        pass
+    '''
+    def _decorate(func):
+        @functools.wraps(func)
+        def _wrapper(*args, **kwargs):
+            request = ctx.request
+            response = ctx.response
+            key = (_BOOT_ID, request.path_info, request.query_string, tuple(request.header(h) for h in vary),
+                   tuple(request.cookie(c) for c in cookies), version(*args, **kwargs))
+            tag = _make_etag(repr(key), weak)
+            for h in vary:
+                _add_vary(response, h)
+            if cookies:
+                _add_vary(response, 'Cookie')
+            if request.request_method == 'GET' and _etag_matches(request, tag):
+                return _not_modified(response, tag)
+            r = func(*args, **kwargs)
+            if response.status_code == 200 and response.header('ETag') is None:
+                response.set_header('ETag', tag)
+            return r
+        return _wrapper
+    return _decorate
+
 _RE_INTERCEPTROR_STARTS_WITH = re.compile(r'^([^\*\?]+)\*?$')
 _RE_INTERCEPTROR_ENDS_WITH = re.compile(r'^\*([^\*\?]+)$')
 
@@ -760,10 +1598,78 @@ def _build_pattern_fn(pattern):
 def interceptor(pattern='/'):
     def _decorator(func):
         func.__interceptor__ = _build_pattern_fn(pattern)
+        func.__interceptor_pattern__ = pattern
         return func
     return _decorator
 
 
+def _interceptor_applies(func, route):
+    '''
+    Decide whether an interceptor applies to every request of a route.
+    Return True or False when it can be decided from the route path, or None
+    when the path parameters decide and the pattern must be checked per request.
+
+    >>> route = Route(get('/manage/blogs/:id')(lambda: None))
+    >>> _interceptor_applies(interceptor('/manage/')(lambda next: None), route)
+    True
+    >>> _interceptor_applies(interceptor('/api/')(lambda next: None), route)
+    False
+    >>> _interceptor_applies(interceptor('/manage/blogs/1*')(lambda next: None), route)
+    >>> _interceptor_applies(interceptor('*.html')(lambda next: None), route)
+
+    Static files skip the interceptors of every path ('/'), such as a user
+    lookup; intercept them under '/static/':
+    >>> import shutil, tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> os.mkdir(os.path.join(root, 'static'))
+    >>> with open(os.path.join(root, 'static', 'x'), 'w') as f:
+    ...     f.write('x')
+    >>> def tracing(pattern):
+    ...     @interceptor(pattern)
+    ...     def _trace(next):
+    ...         print 'intercepted by', pattern
+    ...         return next()
+    ...     return _trace
+    >>> app = WSGIApplication(root)
+    >>> app.add_interceptor(tracing('/'))
+    >>> app.add_interceptor(tracing('/static/'))
+    >>> body = app.get_wsgi_application(static=True)({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/static/x'}, lambda s, h: None)
+    intercepted by /static/
+    >>> ''.join(body)
+    'x'
+    >>> shutil.rmtree(root)
+    '''
+    if route.is_static:
+        return func.__interceptor__(route.path)
+    pattern = getattr(func, '__interceptor_pattern__', None)
+    if pattern is None:
+        return None
+    m = _RE_INTERCEPTROR_STARTS_WITH.match(pattern)
+    if m:
+        prefix = m.group(1)
+        if prefix == '/' and isinstance(route, StaticFileRoute):
+            return False
+        if route.prefix.startswith(prefix):
+            return True
+        return None if prefix.startswith(route.prefix) else False
+    suffix = _RE_INTERCEPTROR_ENDS_WITH.match(pattern).group(1)
+    if route.suffix.endswith(suffix):
+        return True
+    return None if suffix.endswith(route.suffix) else False
+
+
+def _route_interceptors(route, interceptors):
+    '''
+    Return the flattened interceptor chain of a route as (func, always) pairs.
+    '''
+    L = []
+    for f in interceptors:
+        applies = _interceptor_applies(f, route)
+        if applies is not False:
+            L.append((f, applies))
+    return tuple(L)
+
+
 def _build_interceptor_fn(func, next):
     def _wrapper():
         if func.__interceptor__(ctx.request.path_info):
@@ -773,6 +1679,45 @@ def _build_interceptor_fn(func, next):
     return _wrapper
 
 
+def _build_route_chain(last_fn, chain):
+    fn = last_fn
+    for f, always in reversed(chain):
+        fn = functools.partial(f, fn) if always else _build_interceptor_fn(f, fn)
+    return fn
+
+
+def _build_args_link(func, next, always):
+    if always:
+        def _wrapper(*args):
+            return func(functools.partial(next, *args))
+    else:
+        def _wrapper(*args):
+            if func.__interceptor__(ctx.request.path_info):
+                return func(functools.partial(next, *args))
+            return next(*args)
+    return _wrapper
+
+
+def _build_args_chain(last_fn, chain):
+    '''
+    Build once the chain of a route taking path arguments, which are passed
+    through the chain at call time.
+    >>> def log(next):
+    ...     print 'log'
+    ...     return next()
+    >>> fn = _build_args_chain(lambda *args: args, ((log, True), ))
+    >>> fn('blogs', '1')
+    log
+    ('blogs', '1')
+    >>> _build_args_chain(len, ()) is len
+    True
+    '''
+    fn = last_fn
+    for f, always in reversed(chain):
+        fn = _build_args_link(f, fn, always)
+    return fn
+
+
 def _build_interceptor_chain(last_fn, *interceptors):
     L = list(interceptors)
     L.reverse()
@@ -782,6 +1727,53 @@ def _build_interceptor_chain(last_fn, *interceptors):
     return fn
 
 
+_COMPRESSIBLE_TYPES = frozenset([
+    'text/html',
+    'text/plain',
+    'text/css',
+    'text/xml',
+    'text/javascript',
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+])
+
+
+def _compress_response(r, options):
+    '''
+    Compress a fully buffered body when the client accepts it. Streamed
+    bodies, partial content and already encoded responses are returned as is.
+    '''
+    response = ctx.response
+    if response.status_code != 200 or response.header('Content-Encoding'):
+        return r
+    content_type = (response.content_type or '').split(';')[0].strip().lower()
+    if content_type not in options.types:
+        return r
+    _add_vary(response, 'Accept-Encoding')
+    if isinstance(r, list) and all(isinstance(x, str) for x in r):
+        r = ''.join(r)
+    if not isinstance(r, str) or len(r) < options.min_size:
+        return r
+    accepted = _accept_encodings(ctx.request)
+    if 'gzip' in accepted:
+        compressor = zlib.compressobj(options.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        coding = 'gzip'
+    elif options.deflate and 'deflate' in accepted:
+        compressor = zlib.compressobj(options.level)
+        coding = 'deflate'
+    else:
+        return r
+    r = compressor.compress(r) + compressor.flush()
+    response.set_header('Content-Encoding', coding)
+    tag = response.header('ETag')
+    if tag and not tag.startswith('W/'):
+        response.set_header('ETag', tag[:-1] + '-gz"')
+    response.content_length = len(r)
+    return r
+
+
 def _load_module(module_name):
     last_dot = module_name.rfind('.')
     if last_dot == (-1):
@@ -792,6 +1784,197 @@ def _load_module(module_name):
     return getattr(m, import_module)
 
 
+_ROUTE_KEY = 'core.route'
+
+_STATIC_ROUTE = '/static/*'
+
+# set in the environ of the requests sent by warmup():
+_WARMUP_KEY = 'core.warmup'
+
+
+def _metrics_handler(metrics):
+    from core.metrics import CONTENT_TYPE
+
+    def _metrics():
+        ctx.response.content_type = CONTENT_TYPE
+        return metrics.render()
+    return _metrics
+
+
+class _MeteredBody(object):
+    '''
+    Count the bytes of a streamed body and report when the server closes it.
+    '''
+    def __init__(self, body, done):
+        self._body = body
+        self._done = done
+        self._size = 0
+
+    def __iter__(self):
+        for chunk in self._body:
+            self._size = self._size + len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self._body, 'close'):
+                self._body.close()
+        finally:
+            self._done(self._size)
+
+
+def _metered(app, metrics):
+    '''
+    Wrap the WSGI callable to record every request into metrics. Database
+    usage is the difference of the thread local counters of core.db.mysql.
+    '''
+    from core.db.mysql import db_stats
+
+    def wsgi(env, start_response):
+        if _WARMUP_KEY in env:
+            return app(env, start_response)
+        start = time.time()
+        queries, db_time = db_stats()
+        state = []
+
+        def _start_response(status, headers, exc_info=None):
+            state[:] = [status, headers]
+            if exc_info:
+                return start_response(status, headers, exc_info)
+            return start_response(status, headers)
+
+        def _done(size):
+            q, t = db_stats()
+            status = state[0][:3] if state else '500'
+            metrics.observe(env.get('REQUEST_METHOD', ''), env.get(_ROUTE_KEY, '<unmatched>'), status,
+                            time.time() - start, size, q - queries, t - db_time)
+
+        r = app(env, _start_response)
+        if isinstance(r, str):
+            _done(len(r))
+            return r
+        if isinstance(r, (list, tuple)):
+            _done(sum(len(s) for s in r))
+            return r
+        # a file wrapper keeps its sendfile path when the length is known:
+        for k, v in state[1] if state else ():
+            if k.upper() == 'CONTENT-LENGTH':
+                _done(int(v))
+                return r
+        return _MeteredBody(r, _done)
+    return wsgi
+
+
+def _end_request(scopes):
+    for scope in reversed(scopes):
+        try:
+            scope.__exit__(None, None, None)
+        except Exception, e:
+            logging.exception(e)
+    del ctx.application
+    del ctx.request
+    del ctx.response
+
+
+def _is_file_wrapper(r, env):
+    file_wrapper = env.get('wsgi.file_wrapper')
+    return isinstance(file_wrapper, (type, types.ClassType)) and isinstance(r, file_wrapper)
+
+
+class _RequestBody(object):
+    r'''
+    Streamed body of a request. The request context and scopes stay open
+    while the server iterates it and are ended by close(). An error after
+    the first chunk is logged and raised again, so the server drops the
+    connection instead of ending the response as if it was complete.
+
+    >>> import shutil, tempfile
+    >>> tml_dir = tempfile.mkdtemp()
+    >>> with open(os.path.join(tml_dir, 'page.html'), 'w') as f:
+    ...     f.write('<h1>{{ path() }}</h1>{{ fail() }}</html>')
+    >>> def fail():
+    ...     raise ValueError('error in the middle of a template')
+    >>> @view('page.html')
+    ... @get('/page')
+    ... def page():
+    ...     return dict(path=lambda: ctx.request.path_info, fail=fail)
+    >>> app = WSGIApplication('.')
+    >>> app.template_engine = Jinja2TemplateEngine(tml_dir, streaming=True, buffer_size=8)
+    >>> app.add_url(page)
+    >>> status = []
+    >>> body = app.get_wsgi_application()({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/page'}, lambda s, h: status.append(s))
+    >>> chunks = iter(body)
+    >>> status, next(chunks)
+    (['200 OK'], '<h1>/page')
+    >>> next(chunks)
+    Traceback (most recent call last):
+        ...
+    ValueError: error in the middle of a template
+    >>> hasattr(ctx, 'request')
+    True
+    >>> body.close()
+    >>> hasattr(ctx, 'request')
+    False
+    >>> shutil.rmtree(tml_dir)
+    '''
+    def __init__(self, body, cleanup):
+        self._body = body
+        self._cleanup = cleanup
+
+    def __iter__(self):
+        try:
+            for chunk in self._body:
+                yield chunk
+        except Exception:
+            logging.exception('Error while streaming %s:' % ctx.request.path_info)
+            raise
+
+    def close(self):
+        try:
+            if hasattr(self._body, 'close'):
+                self._body.close()
+        finally:
+            self._cleanup()
+
+
+def _warmup_db(n):
+    from core.db import mysql
+    if mysql.engine is not None:
+        mysql.engine.warmup(n)
+
+
+def _warmup_get(wsgi, url):
+    path, _, query = url.partition('?')
+    env = {
+        'REQUEST_METHOD': 'GET',
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTP_HOST': 'localhost',
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': StringIO(''),
+        'wsgi.errors': sys.stderr,
+        'wsgi.version': (1, 0),
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        _WARMUP_KEY: True,
+    }
+    status = []
+    r = wsgi(env, lambda s, headers, exc_info=None: status.append(s))
+    try:
+        for chunk in r:
+            pass
+    finally:
+        if hasattr(r, 'close'):
+            r.close()
+    if not status or status[0][:1] not in '23':
+        raise ValueError('GET %s returned %s' % (url, status[0] if status else 'nothing'))
+
+
 class WSGIApplication(object):
     def __init__(self, document_root=None, **kwargs):
         self._running = False
@@ -802,6 +1985,15 @@ class WSGIApplication(object):
         self._post_static = {}
         self._get_dynamic = []
         self._post_dynamic = []
+        self._compression = None
+        self._etags = None
+        self._metrics = None
+        self._metrics_path = None
+        self._profiler = None
+        self._warmup = Dict(db_connections=0, templates=True, urls=(), primers=[])
+        self._wsgi = None
+        self._request_scopes = []
+        self.ready = True
 
     def _check_not_running(self):
         if self._running:
@@ -845,57 +2037,230 @@ class WSGIApplication(object):
         self._interceptors.append(func)
         logging.info('Add interceptor: %s' % str(func))
 
-    def run(self, port=8888, host='127.0.0.1'):
-        from wsgiref.simple_server import make_server
-        logging.info('application (%s) will start at %s:%s...' % (self._document_root, host, port))
-        server = make_server(host, port, self.get_wsgi_application(debug=True))
+    def enable_compression(self, min_size=1024, level=6, deflate=False, types=_COMPRESSIBLE_TYPES):
+        '''
+        Gzip (or deflate) buffered responses of at least min_size bytes.
+        Static files are never compressed per request, deploy .gz siblings
+        for them (see StaticFileRoute).
+        '''
+        self._check_not_running()
+        self._compression = Dict(min_size=min_size, level=level, deflate=deflate, types=frozenset(types))
+        logging.info('Enable compression: %s' % str(self._compression))
+
+    def enable_etags(self, weak=False):
+        '''
+        Add an ETag hashed from the body to buffered 200 responses of GET
+        requests without one, and answer a matching If-None-Match with 304.
+        Use @etag on handlers that can tell their version without rendering.
+        '''
+        self._check_not_running()
+        self._etags = Dict(weak=weak)
+        logging.info('Enable etags: %s' % str(self._etags))
+
+    def enable_metrics(self, path='/__metrics', metrics=None):
+        '''
+        Record per-route counts, latency, bytes out and database usage and
+        expose them in Prometheus text format on GET path.
+        '''
+        self._check_not_running()
+        from core.metrics import Metrics
+        from core.db.mysql import pool_stats
+        self._metrics = metrics or Metrics()
+        self._metrics.add_gauge('db_pool', pool_stats)
+        self._metrics_path = path
+        logging.info('Enable metrics at %s' % path)
+        return self._metrics
+
+    def enable_profiling(self, directory, header='X-Profile', secret=None, sample_rate=0.0, top=20):
+        '''
+        Run interceptors, handler and template of requests carrying the
+        secret header, or a sample_rate fraction of all requests, under
+        cProfile. See core.profiling.
+        '''
+        self._check_not_running()
+        from core.profiling import Profiler
+        self._profiler = Profiler(directory, header=header, secret=secret, sample_rate=sample_rate, top=top)
+        logging.info('Enable profiling to %s, sample rate %s' % (directory, sample_rate))
+        return self._profiler
+
+    def add_request_scope(self, factory):
+        '''
+        Enter the context manager returned by factory() around every request,
+        it is exited once the response is built, or when the server closes
+        a streamed body. For example, share one
+        database connection per request:
+        app.add_request_scope(mysql.request_connection)
+        '''
+        self._check_not_running()
+        self._request_scopes.append(factory)
+
+    def set_warmup(self, db_connections=0, templates=True, urls=()):
+        '''
+        Configure warmup(): open db_connections database connections,
+        precompile templates and send a GET for every url in urls. Until
+        warmup() has run, requests are answered with 503.
+        '''
+        self._check_not_running()
+        self._warmup.update(db_connections=db_connections, templates=templates, urls=tuple(urls))
+        self.ready = False
+
+    def add_warmup(self, fn):
+        '''
+        Register fn() to run during warmup(), e.g. to fill a cache.
+        '''
+        self._check_not_running()
+        self._warmup.primers.append(fn)
+        self.ready = False
+
+    def warmup(self):
+        '''
+        Run the warmup steps before the process accepts traffic and mark the
+        application ready, the requests received before get a 503. A failing
+        step is logged and the others still run; its GETs are not metered.
+        Return Dict(duration, steps=[(name, seconds, ok)]).
+        '''
+        options = self._warmup
+        steps = []
+        if options.db_connections:
+            steps.append(('db connections', functools.partial(_warmup_db, options.db_connections)))
+        if options.templates and hasattr(self._template_engine, 'precompile'):
+            steps.append(('templates', self._template_engine.precompile))
+        for fn in options.primers:
+            steps.append((getattr(fn, '__name__', str(fn)), fn))
+        for url in options.urls:
+            steps.append(('GET %s' % url, functools.partial(_warmup_get, self._wsgi, url)))
+        start = time.time()
+        results = []
+        for name, fn in steps:
+            t = time.time()
+            try:
+                fn()
+                ok = True
+            except Exception, e:
+                logging.exception('warmup step %s failed:' % name)
+                ok = False
+            results.append((name, time.time() - t, ok))
+        duration = time.time() - start
+        self.ready = True
+        logging.info('warmup done in %.3fs: %s' % (duration, ', '.join('%s %.3fs%s' % (n, t, '' if ok else ' FAILED') for n, t, ok in results)))
+        return Dict(duration=duration, steps=results)
+
+    def run(self, port=8888, host='127.0.0.1', mode='simple', workers=0, **kwargs):
+        '''
+        Serve the application in debug mode. mode is 'simple' (wsgiref),
+        'threaded' (bounded thread pool shedding load with 503) or 'async'
+        (HTTP/1.1 keep-alive event loop), see core.server. With
+        workers > 0, that many processes are forked after the application is
+        loaded (see core.server.PreforkServer). Extra keyword arguments are
+        passed to the server. warmup() runs before the socket is bound, in
+        every worker with prefork.
+        '''
+        from core.server import make_server, PreforkServer
+        logging.info('application (%s) will start at %s:%s in %s mode...' % (self._document_root, host, port, mode))
+        application = self.get_wsgi_application(debug=True)
+        if workers:
+            server = PreforkServer(host, port, application, workers=workers, mode=mode, warmup=self.warmup, **kwargs)
+        else:
+            self.warmup()
+            server = make_server(host, port, application, mode=mode, **kwargs)
+        if self._metrics and hasattr(server, 'stats'):
+            self._metrics.add_gauge('server', server.stats)
         server.serve_forever()
 
-    def get_wsgi_application(self, debug=False):
+    def get_wsgi_application(self, debug=False, static=None):
+        '''
+        Freeze the application and return the WSGI callable.
+
+        Files under document_root/static/ are served when static is True or
+        a StaticFileRoute instance; by default only in debug mode.
+        '''
         self._check_not_running()
-        if debug:
-            self._get_dynamic.append(StaticFileRoute())
+        if static is None:
+            static = debug
+        if static:
+            self._get_dynamic.append(static if isinstance(static, StaticFileRoute) else StaticFileRoute())
         self._running = True
-        _application = Dict(document_root=self._document_root)
+        _application = Dict(document_root=self._document_root, template_engine=self._template_engine)
+        get_dispatcher = _Dispatcher(self._get_dynamic)
+        post_dispatcher = _Dispatcher(self._post_dynamic)
+        interceptors = self._interceptors
+        for route in self._get_dynamic + self._post_dynamic:
+            route.interceptors = _route_interceptors(route, interceptors)
+            route.chain = _build_args_chain(route, route.interceptors)
+        get_static = dict((path, _build_route_chain(route, _route_interceptors(route, interceptors))) for path, route in self._get_static.iteritems())
+        post_static = dict((path, _build_route_chain(route, _route_interceptors(route, interceptors))) for path, route in self._post_static.iteritems())
+
+        def _notfound():
+            raise notfound()
 
-        def fn_route():
-            request_method = ctx.request.request_method
-            path_info = ctx.request_method.path_info
-            if request_method == 'GET':
-                fn = self._get_static.get(path_info, None)
-                if fn:
-                    return fn()
-                for fn in self._get_dynamic:
-                    args = fn.match(path_info)
-                    if args:
-                        return fn(*args)
-                raise notfound()
-            if request_method == 'POST':
-                fn = self._post_static.get(path_info, None)
-                if fn:
-                    return fn()
-                for fn in self._post_dynamic:
-                    args = fn.match(path_info)
-                    if args:
-                        return fn(*args)
-                raise notfound()
+        def _badrequest():
             raise badrequest()
 
-        fn_exec = _build_interceptor_chain(fn_route, *self._interceptors)
+        compression = self._compression
+        etags = self._etags
+        request_scopes = tuple(self._request_scopes)
+        fn_notfound = _build_interceptor_chain(_notfound, *interceptors)
+        fn_badrequest = _build_interceptor_chain(_badrequest, *interceptors)
+
+        metrics = self._metrics
+        if metrics:
+            get_static[self._metrics_path] = _metrics_handler(metrics)
+
+        def fn_route(env):
+            request_method = ctx.request.request_method
+            path_info = ctx.request.path_info
+            if request_method == 'GET':
+                static, dispatcher = get_static, get_dispatcher
+            elif request_method == 'POST':
+                static, dispatcher = post_static, post_dispatcher
+            else:
+                return fn_badrequest()
+            fn = static.get(path_info, None)
+            if fn:
+                env[_ROUTE_KEY] = path_info
+                return fn()
+            fn, args = dispatcher.match(path_info)
+            if fn:
+                env[_ROUTE_KEY] = _STATIC_ROUTE if isinstance(fn, StaticFileRoute) else fn.path
+                return fn.chain(*args)
+            return fn_notfound()
+
+        def fn_handle(env):
+            r = fn_route(env)
+            if isinstance(r, Template):
+                r = self._template_engine(r.template_name, r.model)
+            return r
+
+        if self._profiler:
+            fn_handle = self._profiler.wrap(fn_handle, _ROUTE_KEY)
 
         def wsgi(env, start_response):
+            if not self.ready and _WARMUP_KEY not in env:
+                start_response('503 Service Unavailable', [('Content-Type', 'text/html'), ('Retry-After', '1')])
+                return ['<html><body><h1>503 Service Unavailable</h1></body></html>']
             ctx.application = _application
             ctx.request = Request(env)
             response = ctx.response = Response()
+            scopes = []
+            body = None
             try:
-                r = fn_exec()
-                if isinstance(r, Template):
-                    r = self._template_engine(r.template_name, r.model)
+                for factory in request_scopes:
+                    scope = factory()
+                    scope.__enter__()
+                    scopes.append(scope)
+                r = fn_handle(env)
                 if isinstance(r, unicode):
                     r = r.encode('utf-8')
                 if r is None:
                     r = []
+                if etags and ctx.request.request_method == 'GET':
+                    r = _etag_response(r, etags)
+                if compression and env.get(_ROUTE_KEY) != _STATIC_ROUTE:
+                    r = _compress_response(r, compression)
                 start_response(response.status, response.headers)
+                if not isinstance(r, (str, list, tuple)) and not _is_file_wrapper(r, env):
+                    # rendered while the server iterates, the request ends on close():
+                    body = r = _RequestBody(r, functools.partial(_end_request, scopes))
                 return r
             except RedirectError, e:
                 response.set_header('Location', e.location)
@@ -919,9 +2284,11 @@ class WSGIApplication(object):
                     stacks.replace('<', '&lt;').replace('>', '&gt;'),
                     '</pre></div></body></html>']
             finally:
-                del ctx.application
-                del ctx.request
-                del ctx.response
+                if body is None:
+                    _end_request(scopes)
+        if metrics:
+            wsgi = _metered(wsgi, metrics)
+        self._wsgi = wsgi
         return wsgi
 
 
@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
+import os
 import time
 import uuid
+import operator
 import functools
 import threading
 import logging
+import collections
 from core.utils import Dict
 
 
@@ -19,6 +22,10 @@ class ColumnTypeError(DBError):
     pass
 
 
+class PoolTimeoutError(DBError):
+    pass
+
+
 def next_id(t=None):
     '''
     Return next id as 50-char string
@@ -31,37 +38,171 @@ def next_id(t=None):
     return '%015d%s000' % (int(t * 1000), uuid.uuid4().hex)
 
 
+class _DbStats(threading.local):
+    '''
+    Thread local counters of executed statements and time spent in the database.
+    '''
+    def __init__(self):
+        self.queries = 0
+        self.time = 0.0
+
+_db_stats = _DbStats()
+
+
+def db_stats():
+    '''
+    Return (queries, seconds) executed by the current thread so far.
+    '''
+    return _db_stats.queries, _db_stats.time
+
+
 def _profiling(start, sql=''):
     t = time.time() - start
+    if sql:
+        _db_stats.queries = _db_stats.queries + 1
+        _db_stats.time = _db_stats.time + t
     if t > 0.1:
-        logging.warning('[PROFILING] [DB] %s: %s' % (t, sql))
+        logging.warning('[PROFILING] [DB] %s: %s', t, sql)
     else:
-        logging.info('[PROFILING] [DB] %s: %s' % (t, sql))
+        logging.debug('[PROFILING] [DB] %s: %s', t, sql)
+
+
+_STATEMENT_CACHE_SIZE = 1024
+
+_statements = {}
+
+
+def _statement(sql):
+    '''
+    Return sql with the ? placeholders in the paramstyle of the engine. The
+    translation is done once per SQL text, a full cache is simply dropped.
+    '''
+    if engine.paramstyle == 'qmark':
+        return sql
+    s = _statements.get(sql)
+    if s is None:
+        if len(_statements) >= _STATEMENT_CACHE_SIZE:
+            _statements.clear()
+        s = _statements[sql] = sql.replace('?', '%s')
+    return s
+
+
+class Row(tuple):
+    '''
+    Read-only result row. The rows of a result set share one Row subclass
+    holding the column index, so a row costs a tuple instead of a dict.
+    Columns are read by attribute, name or position:
+    >>> R = row_type(('id', 'name'))
+    >>> r = R((1, u'Michael'))
+    >>> r.name, r['id'], r[1]
+    (u'Michael', 1, u'Michael')
+    >>> r.keys(), r.get('email', 'n/a')
+    (('id', 'name'), 'n/a')
+    >>> dict(**r) == {'id': 1, 'name': u'Michael'}
+    True
+    >>> r.email
+    Traceback (most recent call last):
+        ...
+    AttributeError: Row object has no attribute 'email'
+    >>> row_type(['id', 'name']) is R
+    True
+
+    Columns may shadow the tuple methods count and index, not the methods
+    of Row itself:
+    >>> row_type(('count', 'index'))((3, 0)).count
+    3
+    >>> row_type(('id', 'items'))
+    Traceback (most recent call last):
+        ...
+    ColumnTypeError: column "items" conflicts with Row.items, select it with an alias.
+    '''
+    __slots__ = ()
+    _fields = ()
+    _index = {}
+
+    def __getattr__(self, key):
+        try:
+            return tuple.__getitem__(self, self._index[key])
+        except KeyError:
+            raise AttributeError(r"Row object has no attribute '%s'" % key)
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return tuple.__getitem__(self, self._index[key])
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        i = self._index.get(key)
+        return default if i is None else tuple.__getitem__(self, i)
+
+    def keys(self):
+        return self._fields
+
+    def items(self):
+        return zip(self._fields, self)
+
+    def to_dict(self):
+        return Dict(self._fields, self)
+
+
+_row_types = {}
+
+_ROW_ATTRIBUTES = frozenset(dir(Row))
+
+# tuple methods a column may shadow:
+_ROW_SHADOWABLE = frozenset(['count', 'index'])
+
+
+def row_type(names):
+    '''
+    Return the Row subclass of the columns names, created once per columns.
+    '''
+    names = tuple(names)
+    t = _row_types.get(names)
+    if t is None:
+        if len(_row_types) >= _STATEMENT_CACHE_SIZE:
+            _row_types.clear()
+        attrs = dict(__slots__=(), _fields=names, _index=dict((n, i) for i, n in enumerate(names)))
+        for i, n in enumerate(names):
+            if n in _ROW_ATTRIBUTES:
+                if n not in _ROW_SHADOWABLE:
+                    raise ColumnTypeError('column "%s" conflicts with Row.%s, select it with an alias.' % (n, n))
+                attrs[n] = property(operator.itemgetter(i))
+        t = _row_types[names] = type('Row', (Row, ), attrs)
+    return t
 
 
 class _LazyConnection(object):
+    '''
+    Connection taken from the pool on the first cursor(). It is dirty from
+    the first statement to the next commit or rollback.
+    '''
     def __init__(self):
         self.connection = None
+        self.dirty = False
 
     def cursor(self):
         if self.connection is None:
             connection = engine.connect()
             logging.info('open connection <%s>...' % hex(id(connection)))
             self.connection = connection
+        self.dirty = True
         return self.connection.cursor()
 
     def commit(self):
         self.connection.commit()
+        self.dirty = False
 
     def rollback(self):
         self.connection.rollback()
+        self.dirty = False
 
     def cleanup(self):
         if self.connection:
             connection = self.connection
             self.connection = None
-            logging.info('close connection <%s>...' % hex(id(connection)))
-            connection.close()
+            logging.info('release connection <%s>...' % hex(id(connection)))
+            engine.release(connection, self.dirty)
 
 
 class _DbCtx(threading.local):
@@ -71,6 +212,7 @@ class _DbCtx(threading.local):
     def __init__(self):
         self.connection = None
         self.transactions = 0
+        self.after_commit = []
 
     def is_init(self):
         return not self.connection is None
@@ -79,6 +221,7 @@ class _DbCtx(threading.local):
         logging.info('open lazy connection...')
         self.connection = _LazyConnection()
         self.transactions = 0
+        self.after_commit = []
 
     def cleanup(self):
         self.connection.cleanup()
@@ -94,12 +237,192 @@ _db_ctx = _DbCtx()
 engine = None
 
 
-class _Engine(object):
-    def __init__(self, connect):
+def _ping(connection):
+    if hasattr(connection, 'ping'):
+        connection.ping()
+    else:
+        cursor = connection.cursor()
+        try:
+            cursor.execute('select 1')
+        finally:
+            cursor.close()
+
+
+def _close_quietly(connection):
+    try:
+        connection.close()
+    except Exception, e:
+        logging.warning('close connection failed: %s' % e)
+
+
+class _Pool(object):
+    '''
+    Thread safe pool of connections.
+
+    Up to size connections are kept idle for reuse, up to max_overflow more
+    are opened under load and closed when returned to a full pool. acquire() waits at most
+    timeout seconds for a connection. A connection idle for more than
+    ping_interval seconds is pinged before it is handed out; connections
+    idle longer than max_idle or older than max_lifetime are closed instead.
+    Connections returned dirty are rolled back so no transaction or
+    snapshot leaks into the next checkout. Connections inherited through fork() are
+    dropped without being closed, as the parent still uses them.
+    '''
+    def __init__(self, connect, size=10, max_overflow=10, timeout=30.0, min_size=0,
+                 ping_interval=1.0, max_idle=600.0, max_lifetime=3600.0):
         self._connect = connect
+        self._size = size
+        self._max_overflow = max_overflow
+        self._timeout = timeout
+        self._min_size = min_size
+        self._ping_interval = ping_interval
+        self._max_idle = max_idle
+        self._max_lifetime = max_lifetime
+        self._cond = threading.Condition(threading.Lock())
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = collections.deque()
+        self._born = {}
+        self._opened = 0
+        self._stats = dict(checkouts=0, waits=0, timeouts=0, created=0, recycled=0, ping_failures=0)
+
+    def acquire(self):
+        deadline = None
+        with self._cond:
+            if self._pid != os.getpid():
+                self._reset()
+            self._stats['checkouts'] += 1
+        while True:
+            with self._cond:
+                while not self._idle and self._opened >= self._size + self._max_overflow:
+                    if deadline is None:
+                        deadline = time.time() + self._timeout
+                        self._stats['waits'] += 1
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolTimeoutError('No connection available in %s seconds.' % self._timeout)
+                    self._cond.wait(remaining)
+                if not self._idle:
+                    self._opened += 1
+                    break
+                connection, released = self._idle.pop()
+                born = self._born[id(connection)]
+            # checked without the lock, a ping or close may block on the network:
+            now = time.time()
+            if now - released > self._max_idle or now - born > self._max_lifetime:
+                self._discard(connection, 'recycled')
+                continue
+            if now - released > self._ping_interval:
+                try:
+                    _ping(connection)
+                except Exception, e:
+                    logging.warning('drop connection failing ping: %s' % e)
+                    self._discard(connection, 'ping_failures')
+                    continue
+            return connection
+        try:
+            connection = self._connect()
+        except:
+            with self._cond:
+                self._opened -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._born[id(connection)] = time.time()
+            self._stats['created'] += 1
+        return connection
+
+    def release(self, connection, dirty=True):
+        with self._cond:
+            inherited = self._pid != os.getpid()
+        if inherited:
+            return
+        try:
+            if dirty:
+                connection.rollback()
+        except Exception, e:
+            logging.warning('drop connection failing rollback: %s' % e)
+            self._discard(connection)
+            return
+        with self._cond:
+            keep = len(self._idle) < self._size and id(connection) in self._born
+            if keep:
+                self._idle.append((connection, time.time()))
+            else:
+                self._forget(connection)
+            self._cond.notify()
+        if not keep:
+            _close_quietly(connection)
+
+    def _forget(self, connection):
+        # called with the lock held:
+        if self._born.pop(id(connection), None) is not None:
+            self._opened -= 1
+
+    def _discard(self, connection, stat=None):
+        with self._cond:
+            self._forget(connection)
+            if stat:
+                self._stats[stat] += 1
+            self._cond.notify()
+        _close_quietly(connection)
+
+    def fill(self, n):
+        '''
+        Open connections until max(n, min_size) are idle, at most size.
+        '''
+        n = min(max(n, self._min_size), self._size)
+        connections = []
+        try:
+            while len(connections) < n:
+                connections.append(self.acquire())
+        finally:
+            for c in connections:
+                self.release(c)
+        return len(connections)
+
+    def stats(self):
+        with self._cond:
+            d = dict(self._stats)
+            d.update(size=self._size, max_overflow=self._max_overflow, opened=self._opened,
+                     idle=len(self._idle), in_use=self._opened - len(self._idle))
+        return d
+
+
+def _cursor(connection):
+    return connection.cursor()
+
+
+class _Engine(object):
+    def __init__(self, connect, paramstyle='format', stream_cursor=_cursor, **pool_options):
+        self.pool = _Pool(connect, **pool_options)
+        self.paramstyle = paramstyle
+        self.stream_cursor = stream_cursor
 
     def connect(self):
-        return self._connect()
+        return self.pool.acquire()
+
+    def release(self, connection, dirty=True):
+        self.pool.release(connection, dirty)
+
+    def warmup(self, n=1):
+        '''
+        Fill the pool with n connections before the first request, so the
+        driver is loaded and the database known to be reachable.
+        '''
+        n = self.pool.fill(n)
+        logging.info('warmup opened %d pooled connections.' % n)
+        return n
+
+
+def pool_stats():
+    '''
+    Return the counters of the connection pool, {} without engine.
+    '''
+    return engine.pool.stats() if engine is not None else {}
 
 
 class _ConnectionCtx(object):
@@ -134,6 +457,29 @@ def connection():
     return _ConnectionCtx()
 
 
+class _RequestConnectionCtx(_ConnectionCtx):
+    '''
+    Connection scope of a whole request. The connection is only taken from
+    the pool by the first statement. A transaction left open is rolled back
+    when the connection is returned.
+    '''
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _db_ctx
+        if self.should_cleanup and _db_ctx.transactions:
+            logging.warning('request left %d transactions open, rollback.' % _db_ctx.transactions)
+            _db_ctx.transactions = 0
+            _db_ctx.after_commit = []
+        super(_RequestConnectionCtx, self).__exit__(exc_type, exc_value, traceback)
+
+
+def request_connection():
+    '''
+    Return a scope sharing one connection between all statements of a
+    request, see WSGIApplication.add_request_scope().
+    '''
+    return _RequestConnectionCtx()
+
+
 def with_connection(func):
     '''
     Decorator for reuse connection
@@ -159,7 +505,7 @@ class _TransactionCtx(object):
         global _db_ctx
         self.should_close_conn = False
         if not _db_ctx.is_init():
-            _db_ctx.Init()
+            _db_ctx.init()
             self.should_close_conn = True
         _db_ctx.transactions = _db_ctx.transactions + 1
         logging.info('begin transaction...' if _db_ctx.transactions == 1 else 'join current transaction...')
@@ -168,33 +514,38 @@ class _TransactionCtx(object):
     def __exit__(self, exc_type, exc_value, traceback):
         global _db_ctx
         _db_ctx.transactions = _db_ctx.transactions - 1
+        callbacks = ()
         try:
             if _db_ctx.transactions == 0:
+                pending, _db_ctx.after_commit = _db_ctx.after_commit, []
                 if exc_type is None:
                     self.commit()
+                    callbacks = pending
                 else:
                     self.rollback()
         finally:
             if self.should_close_conn:
                 _db_ctx.cleanup()
+        for fn in callbacks:
+            fn()
 
-        def commit(self):
-            global _db_ctx
-            logging.info('commit transaction...')
-            try:
-                _db_ctx.connection.commit()
-                logging.info('commit ok.')
-            except:
-                logging.warning('commit failed. try rollback...')
-                _db_ctx.connection.rollback()
-                logging.warning('rollback ok.')
-                raise
-
-        def rollback(self):
-            global _db_ctx
-            logging.warning('rollback transaction...')
+    def commit(self):
+        global _db_ctx
+        logging.info('commit transaction...')
+        try:
+            _db_ctx.connection.commit()
+            logging.info('commit ok.')
+        except:
+            logging.warning('commit failed. try rollback...')
             _db_ctx.connection.rollback()
-            logging.info('rollback ok.')
+            logging.warning('rollback ok.')
+            raise
+
+    def rollback(self):
+        global _db_ctx
+        logging.warning('rollback transaction...')
+        _db_ctx.connection.rollback()
+        logging.info('rollback ok.')
 
 
 def transaction():
@@ -206,13 +557,28 @@ def transaction():
     return _TransactionCtx()
 
 
+def after_commit(fn):
+    '''
+    Call fn() once the current transaction is committed, or at once outside
+    a transaction, where every statement is committed by itself. fn is
+    dropped if the transaction is rolled back.
+    '''
+    global _db_ctx
+    if _db_ctx.is_init() and _db_ctx.transactions:
+        _db_ctx.after_commit.append(fn)
+    else:
+        fn()
+
+
 def with_transaction(func):
     @functools.wraps(func)
     def _wrapper(*args, **kwargs):
         _start = time.time()
-        with _TransactionCtx():
-            return func(*args, **kwargs)
-        _profiling(_start)
+        try:
+            with _TransactionCtx():
+                return func(*args, **kwargs)
+        finally:
+            _profiling(_start)
     return _wrapper
 
 
@@ -220,8 +586,9 @@ def _select(sql, first, *args):
     'execute select SQL and return unique result or list results'
     global _db_ctx
     cursor = None
-    sql = sql.replace('?', '%s')
-    logging.info('SQL: %s, ARGS: %s' % (sql, args))
+    sql = _statement(sql)
+    logging.info('SQL: %s, ARGS: %s', sql, args)
+    _start = time.time()
     try:
         cursor = _db_ctx.connection.cursor()
         cursor.execute(sql, args)
@@ -237,6 +604,7 @@ def _select(sql, first, *args):
     finally:
         if cursor:
             cursor.close()
+        _profiling(_start, sql)
 
 
 @with_connection
@@ -250,9 +618,9 @@ def select_int(sql, *args):
     if len(d) != 1:
         raise MultiColumnsError('Expect only one column')
     v = d.values()[0]
-    if not isinstance(v, int):
+    if not isinstance(v, (int, long)):
         raise ColumnTypeError('Expect only integer column')
-    return d.values()[0]
+    return v
 
 
 @with_connection
@@ -261,22 +629,85 @@ def select(sql, *args):
 
 
 @with_connection
-def _update(sql, *args):
+def select_rows(sql, *args):
+    '''
+    Execute select SQL and return a list of Row, which is much lighter than
+    select() for big results. Convert on demand with Model.from_row(row).
+    '''
     global _db_ctx
     cursor = None
-    sql = sql.replace('?', '%s')
-    logging.info('SQL: %s, ARGS: %s' % (sql, args))
+    sql = _statement(sql)
+    logging.info('SQL: %s, ARGS: %s', sql, args)
+    _start = time.time()
     try:
-            cursor = _db_ctx.connection.cursor()
+        cursor = _db_ctx.connection.cursor()
+        cursor.execute(sql, args)
+        return map(row_type([x[0] for x in cursor.description]), cursor.fetchall())
+    finally:
+        if cursor:
+            cursor.close()
+        _profiling(_start, sql)
+
+
+def iter_select(sql, *args, **kw):
+    '''
+    Execute select SQL and yield the rows as Dict, fetched batch_size at a
+    time with an unbuffered cursor, so a whole table can be scanned in
+    constant memory:
+    for row in iter_select('select * from `comments`', batch_size=500):
+        ...
+    The generator runs on a pooled connection of its own, pinned until it is
+    exhausted or closed, so other statements may run while it is consumed
+    (it does not see changes of an uncommitted transaction).
+    '''
+    batch_size = kw.pop('batch_size', 1000)
+    if kw:
+        raise TypeError('unexpected keyword arguments: %s' % ', '.join(kw))
+    sql = _statement(sql)
+    logging.info('SQL: %s, ARGS: %s', sql, args)
+    connection = engine.connect()
+    cursor = None
+    try:
+        _start = time.time()
+        try:
+            cursor = engine.stream_cursor(connection)
             cursor.execute(sql, args)
-            r = cursor.rowcount
-            if _db_ctx.transaction == 0:
-                logging.info('auto commit')
-                _db_ctx.connection.commit()
-            return r
+        finally:
+            _profiling(_start, sql)
+        names = [x[0] for x in cursor.description]
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for values in rows:
+                yield Dict(names, values)
+    finally:
+        try:
+            if cursor:
+                cursor.close()
+        finally:
+            engine.release(connection)
+
+
+@with_connection
+def _update(sql, *args):
+    global _db_ctx
+    cursor = None
+    sql = _statement(sql)
+    logging.info('SQL: %s, ARGS: %s', sql, args)
+    _start = time.time()
+    try:
+        cursor = _db_ctx.connection.cursor()
+        cursor.execute(sql, args)
+        r = cursor.rowcount
+        if _db_ctx.transactions == 0:
+            logging.info('auto commit')
+            _db_ctx.connection.commit()
+        return r
     finally:
         if cursor:
             cursor.close()
+        _profiling(_start, sql)
 
 
 def insert(table, **kwargs):
@@ -290,33 +721,86 @@ def update(sql, *args):
 
 
 def mysql_engine(user, password, database, host='127.0.0.1', port=3306, **kwargs):
-    import MySQLdb
     params = dict(user=user, passwd=password, db=database, host=host, port=port)
     defaults = dict(use_unicode=True, charset='utf8', connect_timeout=10)
     for k, v in defaults.iteritems():
         params[k] = kwargs.pop(k, v)
     params.update(kwargs)
-    return lambda: MySQLdb.connect(**params)
+
+    def _connect():
+        import MySQLdb
+        return MySQLdb.connect(**params)
+    return _connect
+
+
+def _mysql_stream_cursor(connection):
+    # unbuffered: rows stay on the server until fetched
+    from MySQLdb.cursors import SSCursor
+    return connection.cursor(SSCursor)
+
+
+def sqlite_engine(user, password, database, host=None, port=None, **kwargs):
+    '''
+    SQLite connector for local tests and benchmarks, database is the file
+    name. It accepts the backtick quoting of the generated SQL. Each
+    connection keeps its last cached_statements prepared statements.
+    '''
+    import sqlite3
+    # pooled connections move between threads, one at a time:
+    kwargs.setdefault('check_same_thread', False)
+    kwargs.setdefault('cached_statements', 256)
+    return lambda: sqlite3.connect(database, **kwargs)
+
+
+_PARAMSTYLES = {
+    'mysql': 'format',
+    'sqlite': 'qmark',
+}
+
+# sqlite cursors already step through the result as it is fetched:
+_STREAM_CURSORS = {
+    'mysql': _mysql_stream_cursor,
+    'sqlite': _cursor,
+}
 
 
 def select_engine(name='mysql'):
     mapping = {
         'mysql': mysql_engine,
+        'sqlite': sqlite_engine,
     }
     if name in mapping:
         return mapping[name]
 
 
+_POOL_OPTIONS = {
+    'pool_size': 'size',
+    'pool_max_overflow': 'max_overflow',
+    'pool_timeout': 'timeout',
+    'pool_min_size': 'min_size',
+    'pool_ping_interval': 'ping_interval',
+    'pool_max_idle': 'max_idle',
+    'pool_max_lifetime': 'max_lifetime',
+}
+
+
 def create_engine(engine_name, user, password, database, host='127.0.0.1', port=3306, **kwargs):
+    '''
+    Create the global engine. Connections are pooled, see _Pool for the
+    pool_size, pool_max_overflow, pool_timeout, pool_min_size,
+    pool_ping_interval, pool_max_idle and pool_max_lifetime arguments. Other
+    keyword arguments are passed to the driver.
+    '''
     global engine
     if engine is not None:
         raise DBError('Engine is already initialized.')
     detail_engine = select_engine(engine_name)
     if detail_engine is None:
         raise DBError('Engine is not supported, %s' % engine_name)
+    pool_options = dict((_POOL_OPTIONS[k], kwargs.pop(k)) for k in kwargs.keys() if k in _POOL_OPTIONS)
     connector = detail_engine(user, password, database, host, port, **kwargs)
-    engine = _Engine(connector)
-    logging.info('Init mysql engine <%s> ok.' % hex(id(engine)))
+    engine = _Engine(connector, _PARAMSTYLES[engine_name], _STREAM_CURSORS[engine_name], **pool_options)
+    logging.info('Init %s engine <%s> ok.' % (engine_name, hex(id(engine))))
 
 
 if __name__ == '__main__':
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import logging
+import functools
 import mysql
 
 
@@ -94,11 +95,26 @@ class VersionField(Field):
 
 _triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete'])
 
+_change_listeners = []
+
+
+def add_change_listener(fn):
+    '''
+    Register fn(table) to be called after a model is inserted, updated or
+    deleted, once the change is committed.
+    '''
+    _change_listeners.append(fn)
+
+
+def _notify_change(table):
+    for fn in _change_listeners:
+        mysql.after_commit(functools.partial(fn, table))
+
 
 def _gen_sql(table_name, mapping):
     pk = None
     sql = ['-- generating SQL for %s:' % table_name, 'create table `%s` (' % table_name]
-    for f in sorted(mapping.values, lambda x, y: cmp(x._order, y._order)):
+    for f in sorted(mapping.values(), lambda x, y: cmp(x.order, y.order)):
         if not hasattr(f, 'ddl'):
             raise StandardError('no ddl in field "%s".' % f)
         ddl = f.ddl
@@ -106,9 +122,9 @@ def _gen_sql(table_name, mapping):
         if f.primary_key:
             pk = f.name
         sql.append(nullable and '  `%s` %s,' % (f.name, ddl) or '  `%s` %s not null,' % (f.name, ddl))
-        sql.append('  primary key(`%s`)' % pk)
-        sql.append(');')
-        return '\n'.join(sql)
+    sql.append('  primary key(`%s`)' % pk)
+    sql.append(');')
+    return '\n'.join(sql)
 
 
 class ModelMetaClass(type):
@@ -132,19 +148,19 @@ class ModelMetaClass(type):
             if isinstance(v, Field):
                 if not v.name:
                     v.name = k
-                    logging.info('Found mapping: %s => %s' % (k, v))
-                    #check duplicate primary key
-                    if v.primary_key:
-                        if primary_key:
-                            raise TypeError('Cannot define more than 1 primary key in class: %s' % name)
-                        if v.updatable:
-                            logging.warning('NOTE: change primary key <%s> to non-updatable.' % k)
-                            v.updatable = False
-                        if v.nullable:
-                            logging.warning('NOTE: change primary key <%s> to non-nullable.' % k)
-                            v.nullable = False
-                        primary_key = v
-                    mapping[k] = v
+                logging.info('Found mapping: %s => %s' % (k, v))
+                #check duplicate primary key
+                if v.primary_key:
+                    if primary_key:
+                        raise TypeError('Cannot define more than 1 primary key in class: %s' % name)
+                    if v.updatable:
+                        logging.warning('NOTE: change primary key <%s> to non-updatable.' % k)
+                        v.updatable = False
+                    if v.nullable:
+                        logging.warning('NOTE: change primary key <%s> to non-nullable.' % k)
+                        v.nullable = False
+                    primary_key = v
+                mapping[k] = v
         #check exist of primary key
         if not primary_key:
             raise TypeError('Primary key not defined in class: %s' % name)
@@ -156,9 +172,21 @@ class ModelMetaClass(type):
         attrs['__mapping__'] = mapping
         attrs['__primary_key__'] = primary_key
         attrs['__sql__'] = lambda self: _gen_sql(attrs['__table__'], mapping)
+        # statements are built once per model instead of once per call:
+        table, pk = attrs['__table__'], primary_key.name
+        updatable = [(k, v) for k, v in mapping.iteritems() if v.updatable]
+        insertable = [(k, v) for k, v in mapping.iteritems() if v.insertable]
+        attrs['__updatable__'] = updatable
+        attrs['__insertable__'] = insertable
+        attrs['__sql_select__'] = 'select * from `%s`' % table
+        attrs['__sql_get__'] = 'select * from `%s` where `%s`=?' % (table, pk)
+        attrs['__sql_count__'] = 'select count(`%s`) from `%s`' % (pk, table)
+        attrs['__sql_update__'] = 'update `%s` set %s where `%s`=?' % (table, ','.join(['`%s`=?' % k for k, v in updatable]), pk)
+        attrs['__sql_delete__'] = 'delete from `%s` where `%s`=?' % (table, pk)
+        attrs['__sql_insert__'] = 'insert into `%s` (%s) values (%s)' % (table, ','.join(['`%s`' % v.name for k, v in insertable]), ','.join(['?'] * len(insertable)))
         for trigger in _triggers:
             if not trigger in attrs:
-                attrs['trigger'] = None
+                attrs[trigger] = None
         return type.__new__(cls, name, bases, attrs)
 
 
@@ -182,7 +210,7 @@ class Model(dict):
         '''
         Get by primary key
         '''
-        d = mysql.select_one('select * from %s where %s=?' % (cls.__table__, cls.__primary_key__.name), pk)
+        d = mysql.select_one(cls.__sql_get__, pk)
         return cls(**d) if d else None
 
     @classmethod
@@ -191,7 +219,7 @@ class Model(dict):
         Find by where clause and return one result. If multiple results found,
         only the first one returned. If no results found, return None
         '''
-        d = mysql.select_one('select * from `%s` %s' % (cls.__table__, where), *args)
+        d = mysql.select_one('%s %s' % (cls.__sql_select__, where), *args)
         return cls(**d) if d else None
 
     @classmethod
@@ -199,7 +227,7 @@ class Model(dict):
         '''
         Find all and return list.
         '''
-        L = mysql.select('select * from `%s`' % cls.__table__)
+        L = mysql.select(cls.__sql_select__)
         return [cls(**d) for d in L]
 
     @classmethod
@@ -207,57 +235,85 @@ class Model(dict):
         '''
         Find by where clause and return list
         '''
-        L = mysql.select('select * from `%s` %s' % (cls.__table__, where), *args)
+        L = mysql.select('%s %s' % (cls.__sql_select__, where), *args)
         return [cls(**d) for d in L]
 
+    @classmethod
+    def find_rows(cls, where, *args):
+        '''
+        Find by where clause and return a list of compact mysql.Row, convert
+        the ones needed with from_row().
+        '''
+        return mysql.select_rows('%s %s' % (cls.__sql_select__, where), *args)
+
+    @classmethod
+    def from_row(cls, row):
+        '''
+        Convert a mysql.Row to a model.
+        '''
+        return cls(**dict(zip(row._fields, row)))
+
+    @classmethod
+    def iter_all(cls, batch_size=1000):
+        '''
+        Iterate over all rows without loading the table in memory.
+        '''
+        for d in mysql.iter_select(cls.__sql_select__, batch_size=batch_size):
+            yield cls(**d)
+
+    @classmethod
+    def iter_by(cls, where, *args, **kw):
+        '''
+        Iterate by where clause without loading the results in memory, see
+        mysql.iter_select for batch_size.
+        '''
+        for d in mysql.iter_select('%s %s' % (cls.__sql_select__, where), *args, **kw):
+            yield cls(**d)
+
     @classmethod
     def count_all(cls):
         '''
         Find by 'select count(pk) from table' and return integer.
         '''
-        return mysql.select_int('select count(`%s`) from `%s`' % (cls.__primary_key__.name, cls.__table__))
+        return mysql.select_int(cls.__sql_count__)
 
     @classmethod
     def count_by(cls, where, *args):
         '''
         Find by 'select count(pk) from table where...' and return int
         '''
-        return mysql.select_int('select count(`%s`) from `$s` %s' % (cls.__primary_key__.name, cls.__table__, where), *args)
+        return mysql.select_int('%s %s' % (cls.__sql_count__, where), *args)
 
     def update(self):
         self.pre_update and self.pre_update()
-        L = []
         args = []
-        for k, v in self.__mapping__.iteritems():
-            if v.updatable:
-                if hasattr(self, k):
-                    arg = getattr(self, k)
-                else:
-                    arg = v.default
-                    setattr(self, k, arg)
-                L.append('`%s`=?' % k)
-                args.append(arg)
-        pk = self.__primary_key__.name
-        args.append(getattr(self, pk))
-        mysql.update('update `%s` set %s where %s=?' % (self.__table__, ','.join(L), pk), *args)
+        for k, v in self.__updatable__:
+            if hasattr(self, k):
+                arg = getattr(self, k)
+            else:
+                arg = v.default
+                setattr(self, k, arg)
+            args.append(arg)
+        args.append(getattr(self, self.__primary_key__.name))
+        mysql.update(self.__sql_update__, *args)
+        _notify_change(self.__table__)
         return self
 
     def delete(self):
         self.pre_delete and self.pre_delete()
-        pk = self.__primary_key__.name
-        args = (getattr(self, pk), )
-        mysql.update('delete from `%s` where `%s`=?' % (self.__table__, pk), *args)
+        mysql.update(self.__sql_delete__, getattr(self, self.__primary_key__.name))
+        _notify_change(self.__table__)
         return self
 
     def insert(self):
         self.pre_insert and self.pre_insert()
-        params = {}
-        for k, v in self.__mapping__.iteritems():
-            if v.insertable:
-                if not hasattr(self, k):
-                    setattr(self, k, v.default)
-                params[v.name] = getattr(self, k)
-        mysql.insert('%s' % self.__table__, **params)
+        args = []
+        for k, v in self.__insertable__:
+            if not hasattr(self, k):
+                setattr(self, k, v.default)
+            args.append(getattr(self, k))
+        mysql.update(self.__sql_insert__, *args)
+        _notify_change(self.__table__)
         return self
 
 
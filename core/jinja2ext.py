@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+'''
+Jinja2 extensions used by Jinja2TemplateEngine.
+
+    {% cache 'blog-list-' ~ page.page_index, 60 %}
+        ... expensive partial ...
+    {% endcache %}
+
+renders the block once per key and serves the result from memory until ttl
+seconds have passed (no ttl: until evicted). The cache is the LRUCache of
+environment.fragment_cache, one per process.
+'''
+import time
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+from core.utils import LRUCache
+
+
+class FragmentCacheExtension(Extension):
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache=LRUCache(1024))
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache_support', args), [], [], body).set_lineno(lineno)
+
+    def _cache_support(self, key, ttl, caller):
+        cache = self.environment.fragment_cache
+        now = time.time()
+        hit = cache.get(key)
+        if hit is not None and (hit[0] is None or hit[0] > now):
+            return hit[1]
+        rv = caller()
+        cache[key] = (now + ttl if ttl else None, rv)
+        return rv
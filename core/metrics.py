@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+'''
+Request metrics in Prometheus text exposition format.
+
+Counters and histograms are keyed by (method, route) where route is the
+registered path pattern, never the raw url, so the number of series stays
+bounded. All updates take one lock, so every thread of a process adds to
+the same numbers. Each process of a prefork server has its own Metrics.
+'''
+import bisect
+import logging
+import threading
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram(object):
+    '''
+    Histogram with fixed upper bounds, rendered cumulatively.
+    >>> h = Histogram((0.1, 1.0))
+    >>> for v in (0.05, 0.5, 0.7, 3.0): h.observe(v)
+    >>> h.cumulative()
+    [(0.1, 1), (1.0, 3), ('+Inf', 4)]
+    >>> h.count, h.sum
+    (4, 4.25)
+    '''
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count = self.count + 1
+        self.sum = self.sum + value
+
+    def cumulative(self):
+        L = []
+        n = 0
+        for bound, c in zip(self.buckets + ('+Inf',), self.counts):
+            n = n + c
+            L.append((bound, n))
+        return L
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(**kw):
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in sorted(kw.iteritems()))
+
+
+def _number(v):
+    if isinstance(v, float):
+        return repr(v)
+    return str(v)
+
+
+class Metrics(object):
+    '''
+    Per-route request counters and latency, response size and database
+    histograms.
+    >>> m = Metrics(buckets=(0.1, 1.0), db_buckets=(0.01,))
+    >>> m.observe('GET', '/blog/:id', 200, 0.05, 1024, 2, 0.004)
+    >>> m.observe('GET', '/blog/:id', 404, 0.2, 12)
+    >>> m.add_gauge('server', lambda: dict(queue_depth=3))
+    >>> text = m.render()
+    >>> 'http_requests_total{method="GET",route="/blog/:id",status="404"} 1' in text
+    True
+    >>> 'http_request_duration_seconds_bucket{le="1.0",method="GET",route="/blog/:id"} 2' in text
+    True
+    >>> 'http_response_bytes_total{method="GET",route="/blog/:id"} 1036' in text
+    True
+    >>> 'db_queries_total{method="GET",route="/blog/:id"} 2' in text
+    True
+    >>> 'server_queue_depth 3' in text
+    True
+    '''
+    def __init__(self, buckets=DEFAULT_BUCKETS, db_buckets=DEFAULT_BUCKETS):
+        self._buckets = tuple(buckets)
+        self._db_buckets = tuple(db_buckets)
+        self._lock = threading.Lock()
+        self._gauges = []
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._requests = {}
+            self._routes = {}
+
+    def add_gauge(self, name, fn):
+        '''
+        Sample fn() at every render. fn returns a number, or a dict whose
+        items are rendered as name_key.
+        '''
+        self._gauges.append((name, fn))
+
+    def observe(self, method, route, status, duration, bytes_out=0, db_queries=0, db_time=0.0):
+        key = (method, route)
+        with self._lock:
+            k = (method, route, status)
+            self._requests[k] = self._requests.get(k, 0) + 1
+            r = self._routes.get(key)
+            if r is None:
+                r = self._routes[key] = [Histogram(self._buckets), Histogram(self._db_buckets), 0, 0]
+            r[0].observe(duration)
+            r[1].observe(db_time)
+            r[2] = r[2] + bytes_out
+            r[3] = r[3] + db_queries
+
+    def render(self):
+        with self._lock:
+            requests = sorted(self._requests.iteritems())
+            routes = sorted((k, [_copy(r[0]), _copy(r[1]), r[2], r[3]]) for k, r in self._routes.iteritems())
+        L = []
+        L.append('# HELP http_requests_total Requests served, by route and status.')
+        L.append('# TYPE http_requests_total counter')
+        for (method, route, status), n in requests:
+            L.append('http_requests_total%s %d' % (_labels(method=method, route=route, status=status), n))
+        _render_histogram(L, 'http_request_duration_seconds', 'Time spent in the application.', routes, 0)
+        L.append('# HELP http_response_bytes_total Response body bytes sent.')
+        L.append('# TYPE http_response_bytes_total counter')
+        for (method, route), r in routes:
+            L.append('http_response_bytes_total%s %d' % (_labels(method=method, route=route), r[2]))
+        L.append('# HELP db_queries_total Statements executed while serving requests.')
+        L.append('# TYPE db_queries_total counter')
+        for (method, route), r in routes:
+            L.append('db_queries_total%s %d' % (_labels(method=method, route=route), r[3]))
+        _render_histogram(L, 'db_time_seconds', 'Database time per request.', routes, 1)
+        for name, fn in self._gauges:
+            try:
+                v = fn()
+            except Exception, e:
+                logging.warning('metrics gauge %s failed: %s' % (name, e))
+                continue
+            items = sorted(v.iteritems()) if isinstance(v, dict) else [(None, v)]
+            for k, value in items:
+                n = name if k is None else '%s_%s' % (name, k)
+                L.append('# TYPE %s gauge' % n)
+                L.append('%s %s' % (n, _number(value)))
+        L.append('')
+        return '\n'.join(L)
+
+
+def _copy(h):
+    c = Histogram(h.buckets)
+    c.counts = list(h.counts)
+    c.count = h.count
+    c.sum = h.sum
+    return c
+
+
+def _render_histogram(L, name, doc, routes, index):
+    L.append('# HELP %s %s' % (name, doc))
+    L.append('# TYPE %s histogram' % name)
+    for (method, route), r in routes:
+        h = r[index]
+        for bound, n in h.cumulative():
+            L.append('%s_bucket%s %d' % (name, _labels(method=method, route=route, le=bound), n))
+        labels = _labels(method=method, route=route)
+        L.append('%s_sum%s %s' % (name, labels, repr(h.sum)))
+        L.append('%s_count%s %d' % (name, labels, h.count))
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+'''
+Incremental parsers for application/x-www-form-urlencoded and
+multipart/form-data request bodies.
+
+Both parsers read at most CONTENT_LENGTH bytes from wsgi.input in fixed
+size chunks and yield (name, value, filename) tuples. Field values are
+str, uploaded files are file-like objects that stay in memory up to
+spool_size bytes and are written to a temporary file beyond that.
+'''
+import re
+import urllib
+import tempfile
+
+_CHUNK_SIZE = 65536
+_MAX_HEADER_SIZE = 8192
+
+_RE_OPTION = re.compile(r';\s*([^\s=;]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)')
+
+
+class MultipartError(ValueError):
+    pass
+
+
+class BodyTooLargeError(MultipartError):
+    pass
+
+
+def parse_options_header(value):
+    r'''
+    Split a header value into its main value and a dict of options.
+    >>> parse_options_header('form-data; name="file"; filename="a;b.txt"')
+    ('form-data', {'name': 'file', 'filename': 'a;b.txt'})
+    >>> parse_options_header('multipart/form-data; boundary=----xyz')
+    ('multipart/form-data', {'boundary': '----xyz'})
+    '''
+    pos = value.find(';')
+    if pos == -1:
+        return value.strip().lower(), {}
+    options = {}
+    for k, v in _RE_OPTION.findall(value[pos:]):
+        v = v.strip()
+        if len(v) > 1 and v[0] == v[-1] == '"':
+            v = v[1:-1].replace('\\\\', '\\').replace('\\"', '"')
+        options[k.lower()] = v
+    return value[:pos].strip().lower(), options
+
+
+def _read_chunks(fp, length, max_body_size):
+    if length > max_body_size:
+        raise BodyTooLargeError('Request body is larger than %d bytes.' % max_body_size)
+    while length > 0:
+        chunk = fp.read(min(_CHUNK_SIZE, length))
+        if not chunk:
+            raise MultipartError('Unexpected end of request body.')
+        length = length - len(chunk)
+        yield chunk
+
+
+def _check_field(name, value, count, max_fields, max_field_size):
+    if count > max_fields:
+        raise BodyTooLargeError('Too many fields.')
+    if len(value) > max_field_size:
+        raise BodyTooLargeError('Field %s is larger than %d bytes.' % (name, max_field_size))
+
+
+def parse_urlencoded(fp, length, max_body_size, max_field_size, max_fields):
+    '''
+    Parse an urlencoded body pair by pair while it is read.
+    >>> from StringIO import StringIO
+    >>> list(parse_urlencoded(StringIO('a=1&b=x+y&a=%E4%B8%AD&c'), 23, 1024, 1024, 10))
+    [('a', '1', None), ('b', 'x y', None), ('a', '\\xe4\\xb8\\xad', None), ('c', '', None)]
+    '''
+    count = 0
+    buf = ''
+    for chunk in _read_chunks(fp, length, max_body_size):
+        pairs = (buf + chunk).split('&')
+        buf = pairs.pop()
+        if len(buf) > max_field_size * 3:
+            raise BodyTooLargeError('Field is larger than %d bytes.' % max_field_size)
+        for pair in pairs:
+            if pair:
+                count = count + 1
+                yield _decode_pair(pair, count, max_fields, max_field_size)
+    if buf:
+        count = count + 1
+        yield _decode_pair(buf, count, max_fields, max_field_size)
+
+
+def _decode_pair(pair, count, max_fields, max_field_size):
+    name, _, value = pair.partition('=')
+    name = urllib.unquote_plus(name)
+    value = urllib.unquote_plus(value)
+    _check_field(name, value, count, max_fields, max_field_size)
+    return name, value, None
+
+
+def parse_multipart(fp, length, boundary, max_body_size, max_field_size, max_fields, spool_size):
+    r'''
+    Parse a multipart/form-data body part by part while it is read.
+    >>> from StringIO import StringIO
+    >>> body = '--xx\r\nContent-Disposition: form-data; name="a"\r\n\r\n1\r\n--xx\r\nContent-Disposition: form-data; name="f"; filename="t.txt"\r\nContent-Type: text/plain\r\n\r\nhello\r\n--xx--\r\n'
+    >>> [(n, v if f is None else v.read(), f) for n, v, f in parse_multipart(StringIO(body), len(body), 'xx', 1024, 1024, 10, 1024)]
+    [('a', '1', None), ('f', 'hello', 't.txt')]
+
+    A file input left empty (filename="") is a plain field, like with
+    cgi.FieldStorage:
+    >>> body = '--xx\r\nContent-Disposition: form-data; name="f"; filename=""\r\nContent-Type: application/octet-stream\r\n\r\n\r\n--xx--\r\n'
+    >>> list(parse_multipart(StringIO(body), len(body), 'xx', 1024, 1024, 10, 1024))
+    [('f', '', None)]
+    '''
+    if not boundary or len(boundary) > 200:
+        raise MultipartError('Invalid multipart boundary.')
+    delimiter = '--' + boundary
+    separator = '\r\n' + delimiter
+    chunks = _read_chunks(fp, length, max_body_size)
+    buf = ''
+    count = 0
+    # skip the preamble up to the first delimiter:
+    while True:
+        pos = buf.find(delimiter)
+        if pos != -1:
+            buf = buf[pos + len(delimiter):]
+            break
+        buf = buf[-len(delimiter):]
+        buf = buf + _next_chunk(chunks)
+    while True:
+        while len(buf) < 2:
+            buf = buf + _next_chunk(chunks)
+        if buf.startswith('--'):
+            return
+        if not buf.startswith('\r\n'):
+            raise MultipartError('Invalid multipart delimiter.')
+        buf = buf[2:]
+        # part headers:
+        while True:
+            pos = buf.find('\r\n\r\n')
+            if pos != -1:
+                break
+            if len(buf) > _MAX_HEADER_SIZE:
+                raise MultipartError('Multipart header is too large.')
+            buf = buf + _next_chunk(chunks)
+        headers = {}
+        for line in buf[:pos].split('\r\n'):
+            k, _, v = line.partition(':')
+            headers[k.strip().lower()] = v.strip()
+        buf = buf[pos + 4:]
+        disposition, options = parse_options_header(headers.get('content-disposition', ''))
+        name = options.get('name')
+        if disposition != 'form-data' or name is None:
+            raise MultipartError('Invalid Content-Disposition of multipart.')
+        filename = options.get('filename') or None
+        count = count + 1
+        if count > max_fields:
+            raise BodyTooLargeError('Too many fields.')
+        if filename is None:
+            data = []
+            size = 0
+        else:
+            data = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        # part body, keep enough tail to find a separator split across chunks:
+        while True:
+            pos = buf.find(separator)
+            if pos != -1:
+                block, buf = buf[:pos], buf[pos + len(separator):]
+            else:
+                keep = len(separator)
+                block, buf = buf[:-keep], buf[-keep:]
+            if filename is None:
+                size = size + len(block)
+                if size > max_field_size:
+                    raise BodyTooLargeError('Field %s is larger than %d bytes.' % (name, max_field_size))
+                data.append(block)
+            elif block:
+                data.write(block)
+            if pos != -1:
+                break
+            buf = buf + _next_chunk(chunks)
+        if filename is None:
+            yield name, ''.join(data), None
+        else:
+            data.seek(0)
+            yield name, data, filename
+
+
+def _next_chunk(chunks):
+    try:
+        return next(chunks)
+    except StopIteration:
+        raise MultipartError('Unexpected end of multipart body.')
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+'''
+Opt-in cProfile runs of single requests.
+
+A request is profiled when it carries the secret header or falls within
+the sampling rate. Its pstats dump and collapsed stacks (the input of
+flamegraph.pl) are written to directory/<route>/, and the most expensive
+call paths seen for each route are kept as a rolling top-N in top.txt.
+'''
+import os
+import re
+import hmac
+import functools
+import time
+import types
+import random
+import logging
+import cProfile
+import pstats
+import threading
+from collections import Counter
+
+_RE_UNSAFE = re.compile(r'[^A-Za-z0-9_\-]+')
+
+_MAX_DEPTH = 64
+
+
+def _slug(route):
+    '''
+    >>> _slug('/blog/:id')
+    'blog_id'
+    >>> _slug('/')
+    'root'
+    '''
+    return _RE_UNSAFE.sub('_', route).strip('_') or 'root'
+
+
+def _label(func):
+    filename, line, name = func
+    if filename == '~':
+        return name.replace(';', ',')
+    return '%s:%d(%s)' % (os.path.basename(filename), line, name.replace(';', ','))
+
+
+def collapse_stats(stats):
+    '''
+    Turn pstats.Stats into {'root;caller;callee': microseconds}.
+
+    cProfile only records caller->callee edges, so the time of a function is
+    split across its callers in proportion to the time of each edge, the
+    same estimate flame graph tools use for cProfile data.
+    '''
+    raw = stats.stats
+    callees = {}
+    roots = []
+    for func, (cc, nc, tt, ct, callers) in raw.iteritems():
+        if not callers:
+            roots.append(func)
+        for caller, edge in callers.iteritems():
+            callees.setdefault(caller, []).append((func, edge[3]))
+    stacks = Counter()
+
+    def walk(func, path, t, depth):
+        ct, tt = raw[func][3], raw[func][2]
+        path = path + (_label(func),)
+        if ct <= 0 or depth > _MAX_DEPTH:
+            return
+        own = t * tt / ct
+        if own > 0:
+            stacks[';'.join(path)] += own * 1e6
+        for callee, edge_ct in callees.get(func, ()):
+            if callee != func and _label(callee) not in path and edge_ct > 0:
+                walk(callee, path, t * edge_ct / ct, depth + 1)
+
+    for func in roots:
+        walk(func, (), raw[func][3], 0)
+    return dict((k, int(v)) for k, v in stacks.iteritems() if v >= 1)
+
+
+class _ProfiledBody(object):
+    '''
+    Keep profiling a streamed body while it is rendered, record on close().
+    '''
+    def __init__(self, body, prof, done):
+        self._body = body
+        self._prof = prof
+        self._done = done
+
+    def __iter__(self):
+        while True:
+            self._prof.enable()
+            try:
+                chunk = next(self._body)
+            except StopIteration:
+                return
+            finally:
+                self._prof.disable()
+            yield chunk
+
+    def close(self):
+        try:
+            self._body.close()
+        finally:
+            self._done()
+
+
+class Profiler(object):
+    '''
+    Decide per request whether to profile and record the results.
+    '''
+    def __init__(self, directory, header='X-Profile', secret=None, sample_rate=0.0, top=20):
+        self._directory = directory
+        self._environ_key = 'HTTP_%s' % header.upper().replace('-', '_')
+        self._secret = str(secret) if secret else None
+        self._sample_rate = sample_rate
+        self._top = top
+        self._lock = threading.Lock()
+        self._paths = {}
+        self._seq = 0
+
+    def should_profile(self, env):
+        if self._secret:
+            value = env.get(self._environ_key)
+            if value and hmac.compare_digest(value, self._secret):
+                return True
+        return self._sample_rate > 0 and random.random() < self._sample_rate
+
+    def wrap(self, fn, route_key):
+        '''
+        Return fn(env) running under cProfile for selected requests. The
+        route label is read from env[route_key] once fn has dispatched.
+        '''
+        def done(env, prof):
+            try:
+                self.record(env.get(route_key, '<unmatched>'), prof)
+            except Exception, e:
+                logging.exception(e)
+
+        def profiled(env):
+            if not self.should_profile(env):
+                return fn(env)
+            prof = cProfile.Profile()
+            r = None
+            try:
+                r = prof.runcall(fn, env)
+                if isinstance(r, types.GeneratorType):
+                    r = _ProfiledBody(r, prof, functools.partial(done, env, prof))
+                return r
+            finally:
+                if not isinstance(r, _ProfiledBody):
+                    done(env, prof)
+        return profiled
+
+    def top(self, route):
+        '''
+        Return [(path, microseconds)] of the most expensive call paths of route.
+        '''
+        with self._lock:
+            return self._paths.get(route, Counter()).most_common(self._top)
+
+    def record(self, route, prof):
+        stats = pstats.Stats(prof)
+        stacks = collapse_stats(stats)
+        with self._lock:
+            self._seq = self._seq + 1
+            seq = self._seq
+            paths = self._paths.setdefault(route, Counter())
+            paths.update(stacks)
+            # keep some slack below top-N so a path climbing the ranks is not dropped too early:
+            if len(paths) > self._top * 10:
+                self._paths[route] = paths = Counter(dict(paths.most_common(self._top * 5)))
+            top = paths.most_common(self._top)
+        d = os.path.join(self._directory, _slug(route))
+        try:
+            os.makedirs(d)
+        except OSError:
+            if not os.path.isdir(d):
+                raise
+        name = os.path.join(d, '%d-%d-%d' % (int(time.time() * 1000), os.getpid(), seq))
+        stats.dump_stats(name + '.prof')
+        with open(name + '.folded', 'w') as f:
+            for k, v in sorted(stacks.iteritems()):
+                f.write('%s %d\n' % (k, v))
+        with open(os.path.join(d, 'top.txt'), 'w') as f:
+            f.write('# %s\n' % route)
+            for k, v in top:
+                f.write('%10d us  %s\n' % (v, k))
+        logging.info('[PROFILING] %s -> %s.prof' % (route, name))
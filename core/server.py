@@ -0,0 +1,901 @@
+# -*- coding: utf-8 -*-
+'''
+HTTP servers used by WSGIApplication.run().
+
+    simple  wsgiref single threaded server, for development
+    threaded
+            wsgiref server answering on a bounded WorkerPool, shedding
+            load with 503 when the queue is full
+    async   asyncore event loop with HTTP/1.1 keep-alive and pipelining,
+            WSGI handlers run on a bounded WorkerPool
+
+PreforkServer runs several worker processes of one of these modes.
+'''
+import os
+import sys
+import time
+import errno
+import random
+import Queue
+import socket
+import urllib
+import logging
+import asyncore
+import threading
+import collections
+import email.utils
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+_SERVER_NAME = 'study/1.0'
+
+
+class WorkerPool(object):
+    '''
+    Fixed number of daemon threads running jobs from a bounded queue.
+    submit() raises Queue.Full instead of blocking when the queue is full.
+    '''
+    def __init__(self, size=16, queue_size=64, name='worker'):
+        self._queue = Queue.Queue(queue_size)
+        self._threads = []
+        for i in range(size):
+            t = threading.Thread(target=self._work, name='%s-%d' % (name, i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            fn, args = job
+            try:
+                fn(*args)
+            except Exception:
+                logging.exception('Worker job failed:')
+
+    def submit(self, fn, *args):
+        self._queue.put_nowait((fn, args))
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def shutdown(self, timeout=None):
+        '''
+        Stop the threads once queued jobs are done, waiting at most timeout seconds.
+        '''
+        for t in self._threads:
+            self._queue.put(None)
+        deadline = None if timeout is None else time.time() + timeout
+        for t in self._threads:
+            t.join(None if deadline is None else max(deadline - time.time(), 0))
+
+
+class _DateCache(object):
+    '''
+    HTTP Date header value, formatted at most once per second.
+    '''
+    def __init__(self):
+        self._second = 0
+        self._value = ''
+
+    def __call__(self):
+        now = int(time.time())
+        if now != self._second:
+            self._value = email.utils.formatdate(now, usegmt=True)
+            self._second = now
+        return self._value
+
+_http_date = _DateCache()
+
+
+class _Waker(asyncore.dispatcher):
+    '''
+    Self-pipe that wakes the event loop up when a worker thread calls
+    AsyncHTTPServer.call_from_thread().
+    '''
+    def __init__(self, map):
+        r, self._w = socket.socketpair()
+        asyncore.dispatcher.__init__(self, r, map)
+
+    def wake(self):
+        try:
+            self._w.send('x')
+        except socket.error:
+            pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except socket.error:
+            pass
+
+    def handle_close(self):
+        self.close()
+        self._w.close()
+
+
+class _Listener(asyncore.dispatcher):
+    def __init__(self, server, sock, map):
+        asyncore.dispatcher.__init__(self, sock, map)
+        self.accepting = True
+        self._server = server
+
+    def readable(self):
+        # stop accepting when too many connections are open:
+        return self._server.connection_count < self._server.max_connections
+
+    def writable(self):
+        return False
+
+    def handle_accept(self):
+        try:
+            pair = self.accept()
+        except socket.error, e:
+            if e.args[0] in (errno.EMFILE, errno.ENFILE):
+                logging.warning('accept failed: %s' % e)
+                return
+            raise
+        if pair is not None:
+            sock, addr = pair
+            _Channel(self._server, sock, addr)
+
+
+class _HttpParseError(Exception):
+    def __init__(self, status):
+        super(_HttpParseError, self).__init__(status)
+        self.status = status
+
+
+def _parse_head(head):
+    '''
+    Parse request line and headers, return (method, target, version, headers).
+    >>> _parse_head('GET /a?b=1 HTTP/1.1\\r\\nHost: x\\r\\nX-Long: a\\r\\n b')
+    ('GET', '/a?b=1', 'HTTP/1.1', [('Host', 'x'), ('X-Long', 'a b')])
+    '''
+    lines = head.split('\r\n')
+    parts = lines[0].split()
+    if len(parts) != 3 or not parts[2].startswith('HTTP/1.'):
+        raise _HttpParseError('400 Bad Request')
+    headers = []
+    for line in lines[1:]:
+        if line[:1] in (' ', '\t') and headers:
+            name, value = headers[-1]
+            headers[-1] = (name, '%s %s' % (value, line.strip()))
+            continue
+        name, sep, value = line.partition(':')
+        if not sep or not name.strip():
+            raise _HttpParseError('400 Bad Request')
+        headers.append((name.strip(), value.strip()))
+    return parts[0], parts[1], parts[2], headers
+
+
+class _Channel(asyncore.dispatcher):
+    '''
+    One client connection. Requests are parsed in the event loop and run one
+    at a time on the worker pool, so pipelined responses keep their order.
+    Reading stops while too many requests are queued or too much output is
+    unsent.
+    '''
+    MAX_HEADER_SIZE = 65536
+    MAX_PIPELINE = 16
+    HIGH_WATER = 256 * 1024
+    LOW_WATER = 64 * 1024
+
+    def __init__(self, server, sock, addr):
+        asyncore.dispatcher.__init__(self, sock, server.map)
+        self._server = server
+        self._addr = addr
+        self._inbuf = ''
+        self._pending = collections.deque()
+        self._outbuf = collections.deque()
+        self._busy = False
+        self._closing = False
+        self._closed = False
+        self._unsent = 0
+        self._cond = threading.Condition()
+        self.last_activity = time.time()
+        server.connection_count = server.connection_count + 1
+
+    # event loop side:
+
+    def readable(self):
+        return not self._closing and len(self._pending) < self.MAX_PIPELINE and self._unsent < self.HIGH_WATER
+
+    def writable(self):
+        return bool(self._outbuf)
+
+    def handle_read(self):
+        try:
+            data = self.recv(65536)
+        except socket.error:
+            self.handle_close()
+            return
+        if not data:
+            return
+        self.last_activity = time.time()
+        self._inbuf = self._inbuf + data
+        self._parse()
+        self._dispatch()
+
+    def _parse(self):
+        while not self._closing and self._inbuf:
+            self._inbuf = self._inbuf.lstrip('\r\n')
+            pos = self._inbuf.find('\r\n\r\n')
+            if pos == -1:
+                if len(self._inbuf) > self.MAX_HEADER_SIZE:
+                    self._reject('431 Request Header Fields Too Large')
+                return
+            try:
+                method, target, version, headers = _parse_head(self._inbuf[:pos])
+                environ = self._server.make_environ(method, target, version, headers, self._addr)
+                length = int(environ.get('CONTENT_LENGTH') or 0)
+            except _HttpParseError, e:
+                self._reject(e.status)
+                return
+            except ValueError:
+                self._reject('400 Bad Request')
+                return
+            if 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+                self._reject('411 Length Required')
+                return
+            if length > self._server.max_body_size:
+                self._reject('413 Request Entity Too Large')
+                return
+            end = pos + 4 + length
+            if len(self._inbuf) < end:
+                return
+            environ['wsgi.input'] = StringIO(self._inbuf[pos + 4:end])
+            self._inbuf = self._inbuf[end:]
+            connection = environ.get('HTTP_CONNECTION', '').lower()
+            if version == 'HTTP/1.0':
+                keep_alive = connection == 'keep-alive'
+            else:
+                keep_alive = connection != 'close'
+            self._pending.append((environ, keep_alive))
+            if not keep_alive:
+                self._closing = True
+
+    def _reject(self, status):
+        self._closing = True
+        self._inbuf = ''
+        self._pending.append((None, status))
+
+    def _dispatch(self):
+        if self._busy or not self._pending:
+            return
+        environ, keep_alive = self._pending[0]
+        if environ is None:
+            self._pending.popleft()
+            body = '<html><body><h1>%s</h1></body></html>' % keep_alive
+            self._push('HTTP/1.1 %s\r\nContent-Type: text/html\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s' % (keep_alive, len(body), body))
+            return
+        try:
+            self._server.pool.submit(self._run, environ, keep_alive)
+        except Queue.Full:
+            # retried by the server when a worker is free:
+            self._server.wait_for_worker(self)
+            return
+        self._pending.popleft()
+        self._busy = True
+
+    def _push(self, data):
+        if self._closed:
+            return
+        self._outbuf.append(data)
+
+    def _finish(self, keep_alive):
+        self._busy = False
+        self.last_activity = time.time()
+        if not keep_alive:
+            self._closing = True
+            self._pending.clear()
+        if self._closing and not self._pending and not self._outbuf:
+            self.handle_close()
+            return
+        self._dispatch()
+
+    def handle_write(self):
+        if len(self._outbuf) > 1:
+            data = ''.join(self._outbuf)
+            self._outbuf.clear()
+        else:
+            data = self._outbuf.popleft()
+        try:
+            sent = self.send(data)
+        except socket.error:
+            self.handle_close()
+            return
+        if sent < len(data):
+            self._outbuf.appendleft(data[sent:])
+        if sent:
+            self.last_activity = time.time()
+            with self._cond:
+                self._unsent = self._unsent - sent
+                if self._unsent <= self.LOW_WATER:
+                    self._cond.notify_all()
+        if not self._outbuf and self._closing and not self._busy and not self._pending:
+            self.handle_close()
+
+    def handle_close(self):
+        if self._closed:
+            return
+        self._closed = True
+        with self._cond:
+            self._cond.notify_all()
+        self._server.connection_count = self._server.connection_count - 1
+        self.close()
+
+    def handle_error(self):
+        logging.exception('Connection error:')
+        self.handle_close()
+
+    def is_idle(self):
+        return not self._busy and not self._pending and not self._outbuf
+
+    # worker thread side:
+
+    def _send(self, data):
+        '''
+        Queue data for the event loop, blocking while too much is unsent.
+        '''
+        with self._cond:
+            while self._unsent > self.HIGH_WATER and not self._closed:
+                self._cond.wait(1.0)
+            if self._closed:
+                raise socket.error(errno.EPIPE, 'connection closed')
+            self._unsent = self._unsent + len(data)
+        self._server.call_from_thread(self._push, data)
+
+    def _run(self, environ, keep_alive):
+        state = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and 'sent' in state:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            state['status'] = status
+            state['headers'] = headers
+
+        def send_headers(body_length):
+            status, headers = state['status'], list(state['headers'])
+            names = set(name.lower() for name, value in headers)
+            chunked = False
+            if 'content-length' not in names:
+                if body_length is not None:
+                    headers.append(('Content-Length', str(body_length)))
+                elif environ['SERVER_PROTOCOL'] == 'HTTP/1.1':
+                    headers.append(('Transfer-Encoding', 'chunked'))
+                    chunked = True
+                else:
+                    state['keep_alive'] = False
+            if 'date' not in names:
+                headers.append(('Date', _http_date()))
+            if 'server' not in names:
+                headers.append(('Server', _SERVER_NAME))
+            if not state['keep_alive']:
+                headers.append(('Connection', 'close'))
+            elif environ['SERVER_PROTOCOL'] == 'HTTP/1.0':
+                headers.append(('Connection', 'keep-alive'))
+            head = ['%s %s\r\n' % (environ['SERVER_PROTOCOL'], status)]
+            for name, value in headers:
+                head.append('%s: %s\r\n' % (name, value))
+            head.append('\r\n')
+            state['sent'] = True
+            self._send(''.join(head))
+            return chunked
+
+        state['keep_alive'] = keep_alive
+        is_head = environ['REQUEST_METHOD'] == 'HEAD'
+        result = None
+        try:
+            result = self._server.app(environ, start_response)
+            if isinstance(result, str):
+                result = [result]
+            if isinstance(result, (list, tuple)):
+                chunked = send_headers(sum(len(x) for x in result))
+                if not is_head:
+                    for data in result:
+                        if data:
+                            self._send(data)
+            else:
+                chunked = None
+                for data in result:
+                    if chunked is None:
+                        chunked = send_headers(None)
+                    if data and not is_head:
+                        self._send('%x\r\n%s\r\n' % (len(data), data) if chunked else data)
+                if chunked is None:
+                    chunked = send_headers(0)
+                if chunked and not is_head:
+                    self._send('0\r\n\r\n')
+        except socket.error:
+            state['keep_alive'] = False
+        except Exception:
+            logging.exception('Error while serving %s:' % environ.get('PATH_INFO'))
+            state['keep_alive'] = False
+            if 'sent' not in state:
+                body = '<html><body><h1>500 Internal Server Error</h1></body></html>'
+                try:
+                    self._send('%s 500 Internal Server Error\r\nContent-Type: text/html\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s' % (environ['SERVER_PROTOCOL'], len(body), body))
+                except socket.error:
+                    pass
+        finally:
+            if hasattr(result, 'close'):
+                try:
+                    result.close()
+                except Exception:
+                    logging.exception('Error while closing response:')
+            self._server.call_from_thread(self._finish, state['keep_alive'])
+
+
+class AsyncHTTPServer(object):
+    '''
+    Event loop HTTP/1.1 server. Connections are handled by asyncore with
+    poll(), WSGI calls run on a WorkerPool of the given size.
+    '''
+    def __init__(self, host, port, app, workers=16, queue_size=64, max_connections=10000,
+                 keepalive_timeout=15, max_body_size=16 * 1024 * 1024, backlog=1024, sock=None):
+        self.app = app
+        self.map = {}
+        self.max_connections = max_connections
+        self.max_body_size = max_body_size
+        self.connection_count = 0
+        self.pool = WorkerPool(workers, queue_size, name='async-worker')
+        self._keepalive_timeout = keepalive_timeout
+        self._calls = collections.deque()
+        self._waiting = collections.deque()
+        self._running = False
+        self._deadline = 0
+        self._waker = _Waker(self.map)
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((host, port))
+            sock.listen(backlog)
+        sock.setblocking(0)
+        self.socket = sock
+        self._listener = _Listener(self, sock, self.map)
+        host, port = sock.getsockname()[:2]
+        self._base_environ = {
+            'SERVER_NAME': host if host != '0.0.0.0' else socket.gethostname(),
+            'SERVER_PORT': str(port),
+            'SCRIPT_NAME': '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+
+    def make_environ(self, method, target, version, headers, addr):
+        path, _, query = target.partition('?')
+        if path.startswith('http://') or path.startswith('https://'):
+            path = '/' + path.split('/', 3)[-1] if path.count('/') > 2 else '/'
+        environ = self._base_environ.copy()
+        environ['REQUEST_METHOD'] = method
+        environ['PATH_INFO'] = urllib.unquote(path)
+        environ['QUERY_STRING'] = query
+        environ['SERVER_PROTOCOL'] = version
+        environ['REMOTE_ADDR'] = addr[0] if addr else ''
+        for name, value in headers:
+            key = name.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            if key in environ and key.startswith('HTTP_'):
+                value = '%s,%s' % (environ[key], value)
+            environ[key] = value
+        return environ
+
+    def call_from_thread(self, fn, *args):
+        self._calls.append((fn, args))
+        self._waker.wake()
+
+    def wait_for_worker(self, channel):
+        if channel not in self._waiting:
+            self._waiting.append(channel)
+
+    def _run_calls(self):
+        while self._calls:
+            fn, args = self._calls.popleft()
+            fn(*args)
+        # a worker may be free now, give it to a waiting connection:
+        for i in range(len(self._waiting)):
+            channel = self._waiting.popleft()
+            if not channel._closed:
+                channel._dispatch()
+
+    def _close_idle(self):
+        deadline = time.time() - self._keepalive_timeout
+        for channel in self.map.values():
+            if isinstance(channel, _Channel) and channel.is_idle() and channel.last_activity < deadline:
+                channel.handle_close()
+
+    def _has_active(self):
+        for channel in self.map.values():
+            if isinstance(channel, _Channel) and not channel.is_idle():
+                return True
+        return False
+
+    def serve_forever(self):
+        self._running = True
+        last_check = time.time()
+        logging.info('async server listening on %s:%s...' % self.socket.getsockname()[:2])
+        try:
+            while self._running or (time.time() < self._deadline and self._has_active()):
+                asyncore.loop(timeout=1.0, use_poll=True, map=self.map, count=1)
+                self._run_calls()
+                now = time.time()
+                if now - last_check >= 1.0:
+                    self._close_idle()
+                    last_check = now
+        finally:
+            self.pool.shutdown()
+            asyncore.close_all(self.map)
+
+    def shutdown(self, timeout=10):
+        '''
+        Stop accepting and return from serve_forever() once running requests
+        are answered, or after timeout seconds. Safe to call from any thread
+        or a signal handler.
+        '''
+        self.call_from_thread(self._stop, timeout)
+
+    def _stop(self, timeout):
+        if not self._running:
+            return
+        self._running = False
+        self._deadline = time.time() + timeout
+        self._listener.close()
+        for channel in self.map.values():
+            if isinstance(channel, _Channel):
+                channel._closing = True
+                if channel.is_idle():
+                    channel.handle_close()
+
+
+def _make_simple_server(host, port, app, sock=None):
+    if sock is None:
+        server = WSGIServer((host, port), WSGIRequestHandler)
+    else:
+        server = WSGIServer((host, port), WSGIRequestHandler, bind_and_activate=False)
+        server.socket.close()
+        server.socket = sock
+        server.server_address = sock.getsockname()[:2]
+        server.server_name, server.server_port = server.server_address
+        server.setup_environ()
+    server.set_app(app)
+    return server
+
+
+def _make_threaded_server(host, port, app, sock=None, **kwargs):
+    server = ThreadPoolWSGIServer((host, port), WSGIRequestHandler, bind_and_activate=False)
+    server.setup_pool(**kwargs)
+    if sock is None:
+        try:
+            server.server_bind()
+            server.server_activate()
+        except:
+            server.server_close()
+            raise
+    else:
+        server.socket.close()
+        server.socket = sock
+        server.server_address = sock.getsockname()[:2]
+        server.server_name, server.server_port = server.server_address
+        server.setup_environ()
+    server.set_app(app)
+    return server
+
+
+class ThreadPoolWSGIServer(WSGIServer):
+    '''
+    Answer connections on a fixed WorkerPool with a bounded queue. When the
+    queue is full, or a connection waited longer than queue_timeout seconds,
+    a 503 with Retry-After is sent at once instead of queueing more work.
+    '''
+    _REJECT_BODY = '<html><body><h1>503 Service Unavailable</h1></body></html>'
+
+    def setup_pool(self, threads=16, queue_size=64, queue_timeout=5.0, retry_after=1):
+        self.pool = WorkerPool(threads, queue_size, name='http-worker')
+        self._threads = threads
+        self._queue_size = queue_size
+        self._queue_timeout = queue_timeout
+        self._retry_after = retry_after
+        self._stats_lock = threading.Lock()
+        self._accepted = 0
+        self._rejected = 0
+        self._expired = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def process_request(self, request, client_address):
+        try:
+            self.pool.submit(self._process, request, client_address, time.time())
+        except Queue.Full:
+            with self._stats_lock:
+                self._rejected = self._rejected + 1
+            self._reject(request)
+            return
+        with self._stats_lock:
+            self._accepted = self._accepted + 1
+
+    def _process(self, request, client_address, enqueued):
+        wait = time.time() - enqueued
+        with self._stats_lock:
+            self._wait_total = self._wait_total + wait
+            if wait > self._wait_max:
+                self._wait_max = wait
+            if wait > self._queue_timeout:
+                self._expired = self._expired + 1
+        if wait > self._queue_timeout:
+            self._reject(request)
+            return
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def _reject(self, request):
+        try:
+            request.settimeout(1.0)
+            request.sendall('HTTP/1.0 503 Service Unavailable\r\nRetry-After: %d\r\nContent-Type: text/html\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s' % (self._retry_after, len(self._REJECT_BODY), self._REJECT_BODY))
+        except socket.error:
+            pass
+        finally:
+            self.shutdown_request(request)
+
+    def stats(self):
+        '''
+        Return queue depth, wait times and accepted/rejected counters.
+        '''
+        with self._stats_lock:
+            served = self._accepted - self.pool.qsize()
+            return dict(
+                threads=self._threads,
+                queue_depth=self.pool.qsize(),
+                queue_size=self._queue_size,
+                accepted=self._accepted,
+                rejected=self._rejected,
+                expired=self._expired,
+                wait_time_avg=self._wait_total / served if served > 0 else 0.0,
+                wait_time_max=self._wait_max)
+
+    def server_close(self):
+        WSGIServer.server_close(self)
+        self.pool.shutdown(self._queue_timeout)
+
+
+def make_server(host, port, app, mode='simple', **kwargs):
+    '''
+    Create a server object with a serve_forever() method for the given mode.
+    A listening socket can be passed as sock=.
+    '''
+    if mode == 'async':
+        return AsyncHTTPServer(host, port, app, **kwargs)
+    if mode == 'simple':
+        return _make_simple_server(host, port, app, **kwargs)
+    if mode == 'threaded':
+        return _make_threaded_server(host, port, app, **kwargs)
+    raise ValueError('Unknown server mode: %s' % mode)
+
+
+def _listen(host, port, reuse_port=False, backlog=1024):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, _SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+def _rss():
+    '''
+    Resident set size of this process in bytes.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (IOError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# not exported by the socket module of Python 2:
+_SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15 if sys.platform.startswith('linux') else None)
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+class PreforkServer(object):
+    '''
+    Master process forking workers that each run a server of the given mode.
+
+    The application is loaded before forking so its code and data are shared
+    copy-on-write. On Linux every worker binds its own SO_REUSEPORT socket,
+    elsewhere the workers share the socket bound by the master. The master
+    respawns workers that exit, and a worker exits by itself after
+    max_requests requests (plus up to 10%, so workers do not recycle all at
+    once) or when its RSS grew by more than max_rss_growth bytes. Recycling
+    workers always share the master socket: the connections queued on the
+    own socket of an exiting worker would be reset. warmup() is called in
+    each worker before it accepts connections.
+    '''
+    def __init__(self, host, port, app, workers=2, mode='simple', max_requests=0, max_rss_growth=0,
+                 reuse_port=None, backlog=1024, graceful_timeout=10, warmup=None, **kwargs):
+        self._host = host
+        self._port = port
+        self._app = app
+        self._workers = workers
+        self._mode = mode
+        self._max_requests = max_requests
+        self._max_rss_growth = max_rss_growth
+        self._reuse_port = (_SO_REUSEPORT is not None) if reuse_port is None else reuse_port
+        if self._reuse_port and (max_requests or max_rss_growth):
+            logging.info('recycling workers share the master socket, SO_REUSEPORT is not used.')
+            self._reuse_port = False
+        self._backlog = backlog
+        self._graceful_timeout = graceful_timeout
+        self._warmup = warmup
+        self._kwargs = kwargs
+        self._sock = None
+        self._children = {}
+        self._respawns = []
+        self._running = False
+
+    # master:
+
+    def serve_forever(self):
+        import gc
+        import signal
+        if not self._reuse_port:
+            self._sock = _listen(self._host, self._port, False, self._backlog)
+        self._running = True
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        # objects moved to the oldest generation are less likely to be touched after fork:
+        gc.collect()
+        logging.info('prefork master <%d> starts %d %s workers on %s:%s...' % (os.getpid(), self._workers, self._mode, self._host, self._port))
+        for i in range(self._workers):
+            self._spawn()
+        try:
+            while self._running:
+                while self._respawns and self._respawns[0] <= time.time():
+                    self._respawns.pop(0)
+                    self._spawn()
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except OSError, e:
+                    if e.errno not in (errno.EINTR, errno.ECHILD):
+                        raise
+                    pid = 0
+                if not pid:
+                    time.sleep(0.1)
+                    continue
+                started = self._children.pop(pid, None)
+                if started is None or not self._running:
+                    continue
+                if status and time.time() - started < 1.0:
+                    # do not spin when workers crash at startup:
+                    logging.warning('worker <%d> failed with status %d, respawn in 1s.' % (pid, status))
+                    self._respawns.append(time.time() + 1.0)
+                else:
+                    logging.info('worker <%d> exited with status %d' % (pid, status))
+                    self._spawn()
+        finally:
+            self._stop_children()
+
+    def _handle_stop(self, signum, frame):
+        self._running = False
+
+    def _spawn(self):
+        # drawn in the master, the random module is not reseeded after fork:
+        self._limit = self._max_requests + random.randint(0, self._max_requests // 10)
+        pid = os.fork()
+        if pid:
+            self._children[pid] = time.time()
+            return pid
+        status = 0
+        try:
+            self._run_worker()
+        except Exception:
+            logging.exception('worker <%d> failed:' % os.getpid())
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _stop_children(self):
+        import signal
+        for pid in self._children.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        deadline = time.time() + self._graceful_timeout + 1
+        while self._children and time.time() < deadline:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    break
+                continue
+            if pid:
+                self._children.pop(pid, None)
+            else:
+                time.sleep(0.1)
+        for pid in self._children.keys():
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    # worker:
+
+    def _run_worker(self):
+        import signal
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda signum, frame: self._stop_worker())
+        self._alive = True
+        if self._warmup:
+            # before binding, so a SO_REUSEPORT socket gets no connections yet:
+            self._warmup()
+            if not self._alive:
+                return
+        sock = self._sock
+        if sock is None:
+            sock = _listen(self._host, self._port, True, self._backlog)
+        self._requests = 0
+        self._base_rss = _rss()
+        self._server = make_server(self._host, self._port, self._counting_app, mode=self._mode, sock=sock, **self._kwargs)
+        logging.info('worker <%d> ready.' % os.getpid())
+        if self._mode == 'async':
+            self._server.serve_forever()
+        else:
+            self._server.process_request = self._dispatching(self._server.process_request)
+            self._server.timeout = 1.0
+            while self._alive:
+                self._server.handle_request()
+            self._server.server_close()
+
+    def _stop_worker(self):
+        if not self._alive:
+            return
+        self._alive = False
+        if self._mode == 'async' and getattr(self, '_server', None) is not None:
+            self._server.shutdown(self._graceful_timeout)
+
+    def _dispatching(self, process_request):
+        '''
+        Count the connections handed to process_request in the accept loop
+        and stop accepting at the limit, so a threaded worker does not keep
+        queueing connections while earlier ones run.
+        '''
+        def _process_request(request, client_address):
+            self._dispatched = self._dispatched + 1
+            if self._max_requests and self._dispatched >= self._limit:
+                logging.info('worker <%d> recycles after %d requests.' % (os.getpid(), self._dispatched))
+                self._stop_worker()
+            process_request(request, client_address)
+        self._dispatched = 0
+        return _process_request
+
+    def _counting_app(self, environ, start_response):
+        try:
+            return self._app(environ, start_response)
+        finally:
+            self._requests = self._requests + 1
+            if self._mode == 'async' and self._max_requests and self._requests >= self._limit:
+                logging.info('worker <%d> recycles after %d requests.' % (os.getpid(), self._requests))
+                self._stop_worker()
+            elif self._max_rss_growth and self._requests % 16 == 0 and _rss() - self._base_rss > self._max_rss_growth:
+                logging.info('worker <%d> recycles after RSS growth.' % os.getpid())
+                self._stop_worker()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+'''
+Measure where process startup goes.
+
+ImportProfiler replaces __import__ to time every import that loads a new
+module. Self time excludes the modules imported while it ran, cumulative
+time includes them:
+
+    profiler = ImportProfiler().install()
+    import heavy_module
+    profiler.uninstall()
+    print profiler.report()
+'''
+import sys
+import time
+import __builtin__
+
+
+class ImportProfiler(object):
+    def __init__(self):
+        self._original = None
+        self._stack = [[0.0, set()]]
+        self._modules = {}
+        self._order = []
+        self._start = None
+        self._elapsed = None
+
+    def install(self):
+        self._original = __builtin__.__import__
+        __builtin__.__import__ = self._import
+        self._start = time.time()
+        return self
+
+    def uninstall(self):
+        if self._original is not None:
+            __builtin__.__import__ = self._original
+            self._original = None
+            self._elapsed = time.time() - self._start
+
+    def _import(self, name, globals=None, locals=None, fromlist=None, level=-1):
+        before = set(sys.modules)
+        self._stack.append([0.0, set()])
+        start = time.time()
+        try:
+            module = self._original(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.time() - start
+            children, nested = self._stack.pop()
+            parent = self._stack[-1]
+            parent[0] += elapsed
+        loaded = set(sys.modules) - before
+        parent[1].update(loaded)
+        # parent packages and fromlist submodules are loaded without __import__,
+        # None entries only record failed implicit relative imports:
+        own = [m for m in loaded - nested if sys.modules.get(m) is not None]
+        if own:
+            label = min(own, key=len)
+            if len(own) > 1:
+                label = '%s (+%d)' % (label, len(own) - 1)
+            self._order.append(label)
+            self._modules[label] = (elapsed - children, elapsed)
+        return module
+
+    def timings(self):
+        '''
+        Return [(module, self_seconds, cumulative_seconds)] in import order.
+        '''
+        return [(m, ) + self._modules[m] for m in self._order]
+
+    def report(self, top=30):
+        total = self._elapsed if self._elapsed is not None else time.time() - self._start
+        count = len([m for m in self._stack[0][1] if sys.modules.get(m) is not None])
+        L = ['startup: %.1f ms, %d modules imported' % (total * 1000, count),
+             '%10s %10s  %s' % ('self ms', 'cumul ms', 'module')]
+        for name, own, cumulative in sorted(self.timings(), key=lambda t: -t[1])[:top]:
+            L.append('%10.1f %10.1f  %s' % (own * 1000, cumulative * 1000, name))
+        return '\n'.join(L)
@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+import threading
+import importlib
+import collections
 
 
 class Dict(dict):
@@ -27,3 +30,89 @@ class Dict(dict):
             return self[key]
         except KeyError:
             raise AttributeError(r"Dict object has no attribute '%s'" % key)
+
+
+class LRUCache(object):
+    '''
+    Thread-safe mapping that keeps at most capacity items and evicts the
+    least recently used one.
+    >>> c = LRUCache(2)
+    >>> c['a'] = 1
+    >>> c['b'] = 2
+    >>> c.get('a')
+    1
+    >>> c['c'] = 3
+    >>> c.get('b') is None
+    True
+    >>> len(c), 'a' in c, 'c' in c
+    (2, True, True)
+    '''
+
+    def __init__(self, capacity=128):
+        self._capacity = capacity
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self._capacity:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def keys(self):
+        with self._lock:
+            return self._data.keys()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class _LazyModule(object):
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            module = self.__dict__['_module'] = importlib.import_module(self._name)
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return '<lazy module %s%s>' % (self._name, '' if self._module is None else ' (loaded)')
+
+
+def lazy_import(name):
+    '''
+    Return a stand-in for module name that imports it on first attribute
+    access, for optional dependencies only some requests need.
+    >>> md = lazy_import('json')
+    >>> md
+    <lazy module json>
+    >>> md.dumps([1])
+    '[1]'
+    >>> md
+    <lazy module json (loaded)>
+    '''
+    return _LazyModule(name)
@@ -1,12 +1,24 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+'''
+    python manage.py [--profile-startup]
+
+--profile-startup builds the application, prints the time spent importing
+each module and exits without serving.
+'''
 import sys
+
+_import_profiler = None
+if '--profile-startup' in sys.argv:
+    from core.startup import ImportProfiler
+    _import_profiler = ImportProfiler().install()
+
 import os
 import logging
 import time
 from datetime import datetime
-from core.db import mysql
-from core.application import WSGIApplication, Jinja2TemplateEngine
+from core.db import mysql, orm
+from core.application import WSGIApplication, Jinja2TemplateEngine, invalidate_pages
 from settings.config import configs
 
 logging.basicConfig(level=logging.INFO)
@@ -28,18 +40,33 @@ def datetime_filter(t):
     return u'%s-%s-%s' % (dt.year, dt.month, dt.day)
 
 mysql.create_engine(**configs.db)
+orm.add_change_listener(invalidate_pages)
 wsgi = WSGIApplication(root_dir)
-template_engine = Jinja2TemplateEngine(os.path.join(root_dir, 'templates'))
+wsgi.add_request_scope(mysql.request_connection)
+t = configs.templates
+template_engine = Jinja2TemplateEngine(os.path.join(root_dir, 'templates'), production=t.production, cache_dir=t.cache_dir, streaming=t.streaming, buffer_size=t.buffer_size)
 template_engine.add_filter('datetime', datetime_filter)
+if t.production:
+    template_engine.precompile()
 wsgi.template_engine = template_engine
+if configs.profiling.enabled:
+    p = configs.profiling
+    wsgi.enable_profiling(p.directory, header=p.header, secret=p.secret, sample_rate=p.sample_rate, top=p.top)
 
-import urls
+from web import urls
 wsgi.add_module(urls)
+wsgi.set_warmup(db_connections=configs.warmup.db_connections, urls=configs.warmup.urls)
 
 if __name__ == '__main__':
-    wsgi.run(9000, host='0.0.0.0')
+    if _import_profiler:
+        wsgi.get_wsgi_application()
+        _import_profiler.uninstall()
+        print _import_profiler.report()
+    else:
+        wsgi.run(9000, host='0.0.0.0')
 else:
     application = wsgi.get_wsgi_application()
+    wsgi.warmup()
 
 
 
@@ -1,12 +1,34 @@
 configs = {
     'db': {
+        'engine_name': 'mysql',
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'www-data',
         'password': 'www-data',
-        'database': 'awesome'
+        'database': 'awesome',
+        'pool_size': 10,
+        'pool_max_overflow': 10,
+        'pool_timeout': 10
     },
     'session': {
         'secret': 'AwEsOmE'
+    },
+    'templates': {
+        'production': False,
+        'cache_dir': None,
+        'streaming': False,
+        'buffer_size': 8192
+    },
+    'warmup': {
+        'db_connections': 1,
+        'urls': ['/']
+    },
+    'profiling': {
+        'enabled': False,
+        'directory': '/tmp/awesome-profiles',
+        'header': 'X-Profile',
+        'secret': '',
+        'sample_rate': 0.0,
+        'top': 20
     }
 }
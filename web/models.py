@@ -4,8 +4,8 @@
 Models for user, blog, comment.
 '''
 import time, uuid
-from transwarp.db import next_id
-from transwarp.orm import Model, StringField, BooleanField, FloatField, TextField
+from core.db.mysql import next_id
+from core.db.orm import Model, StringField, BoolField, FloatField, TextField
 
 
 class User(Model):
@@ -14,7 +14,7 @@ class User(Model):
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     email = StringField(updatable=False, ddl='varchar(50)')
     password = StringField(ddl='varchar(50)')
-    admin = BooleanField()
+    admin = BoolField()
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(500)')
     created_at = FloatField(updatable=False, default=time.time)
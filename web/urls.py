@@ -3,5 +3,6 @@
 import os, re, time, base64, hashlib, logging
 from core.application import get, post, ctx, view, interceptor, seeother, notfound
 from models import User, Blog, Comment
+from views.user import *
 
 
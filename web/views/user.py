@@ -3,9 +3,11 @@
 import os, re, time, base64, hashlib, logging
 from core.apis import api, Page, APIError, APIValueError, APIPermissionError, APIResourceNotFoundError
 from web.models import User, Blog, Comment
-from settings import configs
-from core.application import get, post, ctx, view, interceptor, seeother, notfound
-import markdown2
+from settings.config import configs
+from core.application import get, post, ctx, view, interceptor, seeother, notfound, cache_page, etag, table_version
+from core.utils import lazy_import
+
+markdown2 = lazy_import('markdown2')
 
 _COOKIE_NAME = 'session'
 _COOKIE_KEY = configs.session.secret
@@ -145,14 +147,26 @@ def api_get_users():
     return dict(users=users)
 
 
+def _index_version(*args):
+    # bumped by the ORM change listener, no query before the page cache:
+    return table_version('blogs', 'users')
+
+
+def _blogs_version(*args):
+    return table_version('blogs')
+
+
+@etag(_index_version)
+@cache_page(ttl=30, tables=('blogs', 'users'))
 @view('blogs.html')
 @get('/')
 def index():
     blogs = Blog.find_all()
-    user = User.find_first('where email=?', 'admin@admin.com')
+    user = User.find_one('where email=?', 'admin@admin.com')
     return dict(blog=blogs, user=user)
 
 
+@etag(_blogs_version)
 @api
 @get('/api/blogs')
 def api_get_blogs():